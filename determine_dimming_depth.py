@@ -2,7 +2,6 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.signal import argrelmin
 
 # Custom modules
 import jedi_config
@@ -12,7 +11,7 @@ __contact__ = 'jmason86@gmail.com'
 
 
 def determine_dimming_depth(light_curve_df,
-                            earliest_allowed_time=None, latest_allowed_time=None, smooth_points=0,
+                            earliest_allowed_time=None, latest_allowed_time=None, smooth_points=0, nan_free=False,
                             plot_path_filename=None):
     """Find the depth of dimming in a light curve, if any.
     Assumes light curve is normalized such that pre-flare = 0%.
@@ -27,6 +26,9 @@ def determine_dimming_depth(light_curve_df,
                                           Default is None, meaning the end of the light_curve_df.
         smooth_points [integer]:          Used to apply a rolling mean with the number of points (indices) specified.
                                           Default is 0, meaning no smoothing will be performed.
+        nan_free [bool]:                  Set if the caller has already filled any NaNs in light_curve_df so the check for
+                                          them can be skipped. Ignored when smooth_points is set since the rolling mean
+                                          introduces NaNs at the edges. Default is False.
         plot_path_filename [str]:         Set to a path and filename in order to save the summary plot to disk.
                                           Default is None, meaning the plot will not be saved to disk.
 
@@ -66,12 +68,15 @@ def determine_dimming_depth(light_curve_df,
         if jedi_config.verbose:
             jedi_config.logger.info('Applied {0} point smooth.'.format(smooth_points))
 
-    first_non_nan = light_curve_df['irradiance'].first_valid_index()
-    nan_indices = np.isnan(light_curve_df['irradiance'])
-    light_curve_df['irradiance'][nan_indices] = light_curve_df['irradiance'][first_non_nan]
+    # Fill any NaNs with the first valid value
+    if smooth_points or not nan_free:
+        nan_indices = np.isnan(light_curve_df['irradiance'])
+        if nan_indices.any():
+            first_non_nan = light_curve_df['irradiance'].first_valid_index()
+            light_curve_df['irradiance'][nan_indices] = light_curve_df['irradiance'][first_non_nan]
 
-    # Find the local minima
-    minima_indices = argrelmin(light_curve_df['irradiance'].values)[0]
+    # Do the number crunching on the raw array
+    minima_indices, depth_first_index, depth_max_index = find_dimming_depth(light_curve_df['irradiance'].values)
     minima_times = light_curve_df.index[minima_indices]
     minima_irradiances = light_curve_df['irradiance'].values[minima_indices]
     if jedi_config.verbose:
@@ -80,16 +85,13 @@ def determine_dimming_depth(light_curve_df,
         else:
             jedi_config.logger.warning('No local minima found.')
 
-    # Apply conditions to obtain first and max dimming depths
-    less_than_zero_indices = minima_indices[minima_irradiances < 0]  # Assumes 0 is the baseline
-    if less_than_zero_indices.size > 0:
-        depth_first_index = less_than_zero_indices[0]
+    # Convert the indices of the first and max dimming depths back to values and times
+    if depth_first_index is not None:
         depth_first_time = light_curve_df.index[depth_first_index]
         depth_first = np.abs(light_curve_df['irradiance'].values[depth_first_index])
 
-        depth_max_index = np.argmax(np.abs(minima_irradiances))
-        depth_max_time = light_curve_df.index[minima_indices[depth_max_index]]
-        depth_max = max(np.abs(minima_irradiances))
+        depth_max_time = light_curve_df.index[depth_max_index]
+        depth_max = np.abs(light_curve_df['irradiance'].values[depth_max_index])
 
         if jedi_config.verbose:
             jedi_config.logger.info('First depth determined to be {0:.2f} at {1}'.format(depth_first, depth_first_time))
@@ -105,10 +107,10 @@ def determine_dimming_depth(light_curve_df,
     # Produce a summary plot
     if plot_path_filename:
         plt.style.use('jpm-transparent-light')
-        plt.close('all')
         from matplotlib import dates
 
-        ax = light_curve_df['irradiance'].plot()
+        fig, ax = plt.subplots()
+        light_curve_df['irradiance'].plot(ax=ax)
         plt.scatter(minima_times, minima_irradiances,
                     c='black', s=300, zorder=3, label='minima')
         if depth_first:
@@ -146,7 +148,39 @@ def determine_dimming_depth(light_curve_df,
                          ha='right', va='center', rotation=90, size=18, color='tomato')
 
         plt.savefig(plot_path_filename)
+        plt.close(fig)
         if jedi_config.verbose:
             jedi_config.logger.info("Summary plot saved to %s" % plot_path_filename)
 
     return depth_first, depth_first_time, depth_max, depth_max_time
+
+
+def find_dimming_depth(irradiance):
+    """Internal-use function to find the local minima and the first and max dimming depths of a light curve array
+
+    Inputs:
+        irradiance [np.array]: The NaN-free irradiance of the light curve, normalized such that pre-flare = 0%.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        minima_indices [np.array]: The indices of the (strict) local minima, same as scipy.signal.argrelmin.
+        depth_first_index [int]:   The index of the first local minimum below 0. None if there isn't one.
+        depth_max_index [int]:     The index of the local minimum with the largest absolute value. None if there is no
+                                   local minimum below 0.
+
+    Optional Outputs:
+        None
+
+    Example:
+        minima_indices, depth_first_index, depth_max_index = find_dimming_depth(light_curve_df['irradiance'].values)
+    """
+    minima_indices = np.where((irradiance[1:-1] < irradiance[:-2]) & (irradiance[1:-1] < irradiance[2:]))[0] + 1
+    minima_irradiances = irradiance[minima_indices]
+
+    less_than_zero_indices = minima_indices[minima_irradiances < 0]  # Assumes 0 is the baseline
+    if less_than_zero_indices.size == 0:
+        return minima_indices, None, None
+
+    return minima_indices, less_than_zero_indices[0], minima_indices[np.argmax(np.abs(minima_irradiances))]
@@ -11,7 +11,7 @@ __contact__ = 'jmason86@gmail.com'
 
 
 def determine_dimming_duration(light_curve_df,
-                               earliest_allowed_time=None, smooth_points=0,
+                               earliest_allowed_time=None, smooth_points=0, nan_free=False,
                                plot_path_filename=None):
     """Find the duration of dimming in a light curve, if any.
     Assumes light curve is normalized such that pre-flare = 0%.
@@ -24,6 +24,9 @@ def determine_dimming_duration(light_curve_df,
                                           Default is None, meaning the beginning of the light_curve_df.
         smooth_points [integer]:          Used to apply a rolling mean with the number of points (indices) specified.
                                           Default is 0, meaning no smoothing will be performed.
+        nan_free [bool]:                  Set if the caller has already filled any NaNs in light_curve_df so the check for
+                                          them can be skipped. Ignored when smooth_points is set since the rolling mean
+                                          introduces NaNs at the edges. Default is False.
         plot_path_filename [str]:         Set to a path and filename in order to save the summary plot to disk.
                                           Default is None, meaning the plot will not be saved to disk.
 
@@ -55,53 +58,28 @@ def determine_dimming_duration(light_curve_df,
     else:
         light_curve_df['smooth'] = light_curve_df['irradiance']
 
-    first_non_nan = light_curve_df['smooth'].first_valid_index()
-    nan_indices = np.isnan(light_curve_df['smooth'])
-    light_curve_df['smooth'][nan_indices] = light_curve_df['smooth'][first_non_nan]
-
-    # Find the indices where the light curve is closest to 0
-    zero_crossing_indices = np.where(np.diff(np.signbit(light_curve_df['smooth'])))[0]
-    zero_crossing_times = light_curve_df.index[zero_crossing_indices]
-
-    # Discard any indices prior to the user-provided earliest_allowed_time, else cannot compute
-    zero_crossing_indices = zero_crossing_indices[zero_crossing_times > earliest_allowed_time]
-    if zero_crossing_indices.size == 0:
+    # Fill any NaNs with the first valid value
+    if smooth_points or not nan_free:
+        nan_indices = np.isnan(light_curve_df['smooth'])
+        if nan_indices.any():
+            first_non_nan = light_curve_df['smooth'].first_valid_index()
+            light_curve_df['smooth'][nan_indices] = light_curve_df['smooth'][first_non_nan]
+
+    # Find the first negative slope zero crossing after earliest_allowed_time and the first positive slope one after that
+    neg_zero_crossing_index, pos_zero_crossing_index = find_dimming_duration(light_curve_df['smooth'].values,
+                                                                             light_curve_df.index.values.view('i8'),
+                                                                             pd.Timestamp(earliest_allowed_time).value)
+    if neg_zero_crossing_index is None:
         if jedi_config.verbose:
-            jedi_config.logger.warning('No zero crossings detected after earliest allowed time of {}'.format(earliest_allowed_time))
+            jedi_config.logger.warning('No negative slope 0-crossing detected after earliest allowed time of {}. Duration cannot be defined.'.format(earliest_allowed_time))
         found_duration = False
-
-    # Figure out which way the light curve is sloping
-    if found_duration:
-        light_curve_df['diff'] = light_curve_df['smooth'].diff()
-
-    # Find the first negative slope zero crossing time
-    if found_duration:
-        neg_zero_crossing_indices = np.where(light_curve_df['diff'][zero_crossing_indices + 1] < 0)[0]
-        if len(neg_zero_crossing_indices) > 0:
-            first_neg_zero_crossing_index = neg_zero_crossing_indices[0]
-            first_neg_zero_crossing_time = light_curve_df.index[zero_crossing_indices[first_neg_zero_crossing_index]]
-        else:
-            if jedi_config.verbose:
-                jedi_config.logger.warning('No negative slope 0-crossing found. Duration cannot be defined.')
-            found_duration = False
-
-    # Find the first subsequent positive slope zero crossing
-    if found_duration:
-        pos_zero_crossing_indices = np.where(light_curve_df['diff'][zero_crossing_indices + 1] > 0)[0]
-        subsequent_pos_zero_crossing_indices = pos_zero_crossing_indices[np.where(light_curve_df.iloc[zero_crossing_indices[pos_zero_crossing_indices]].index > first_neg_zero_crossing_time)[0]]
-        if len(subsequent_pos_zero_crossing_indices) > 0:
-            first_pos_zero_crossing_index = subsequent_pos_zero_crossing_indices[0]
-            first_pos_zero_crossing_time = light_curve_df.index[zero_crossing_indices[first_pos_zero_crossing_index]]
-        else:
-            if jedi_config.verbose:
-                jedi_config.logger.warning('No positive slope 0-crossing found. Duration cannot be defined.')
-            found_duration = False
-
-    # If the first negative slope zero crossing isn't earlier than the positive one, return null
-    if (found_duration) and (first_neg_zero_crossing_time > first_pos_zero_crossing_time):
+    elif pos_zero_crossing_index is None:
         if jedi_config.verbose:
-            jedi_config.logger.warning('Dimming light curve may be misaligned in window. Negative slope 0-crossing detected after positive one.')
+            jedi_config.logger.warning('No positive slope 0-crossing found. Duration cannot be defined.')
         found_duration = False
+    else:
+        first_neg_zero_crossing_time = light_curve_df.index[neg_zero_crossing_index]
+        first_pos_zero_crossing_time = light_curve_df.index[pos_zero_crossing_index]
 
     # Define the time difference in seconds between the selected zero crossings
     if found_duration:
@@ -110,13 +88,10 @@ def determine_dimming_duration(light_curve_df,
 
     if plot_path_filename:
         plt.style.use('jpm-transparent-light')
-        plt.close('all')
         from matplotlib import dates
 
-        if found_duration:
-            light_curve_df = light_curve_df.drop('diff', 1)
-
-        ax = light_curve_df['smooth'].plot()
+        fig, ax = plt.subplots()
+        light_curve_df['smooth'].plot(ax=ax)
         start_date = light_curve_df.index.values[0]
         start_date_string = pd.to_datetime(str(start_date))
         plt.xlabel(start_date_string.strftime('%Y-%m-%d %H:%M:%S'))
@@ -138,6 +113,7 @@ def determine_dimming_duration(light_curve_df,
             plt.annotate(str(duration_seconds) + ' s', xy=(mid_time, 0), xycoords='data', ha='center', va='bottom', size=18)
 
         plt.savefig(plot_path_filename)
+        plt.close(fig)
         if jedi_config.verbose:
             jedi_config.logger.info("Summary plot saved to {}".format(plot_path_filename))
 
@@ -147,3 +123,45 @@ def determine_dimming_duration(light_curve_df,
         first_pos_zero_crossing_time = np.nan
 
     return duration_seconds, first_neg_zero_crossing_time, first_pos_zero_crossing_time
+
+
+def find_dimming_duration(smooth, times, earliest_allowed_time):
+    """Internal-use function to find the zero crossings that bound the dimming in a light curve array
+
+    Inputs:
+        smooth [np.array]:             The NaN-free (optionally smoothed) irradiance of the light curve, normalized such that pre-flare = 0%.
+        times [np.array]:              The times of the light curve as int64 nanoseconds, e.g., DatetimeIndex.values.view('i8').
+        earliest_allowed_time [int]:   Zero crossings at or before this time (int64 nanoseconds) are ignored.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        neg_zero_crossing_index [int]: The index of the first negative slope (downward) zero crossing after earliest_allowed_time.
+                                       None if there isn't one.
+        pos_zero_crossing_index [int]: The index of the first positive slope (upward) zero crossing after that.
+                                       None if there isn't one.
+
+    Optional Outputs:
+        None
+
+    Example:
+        neg_zero_crossing_index, pos_zero_crossing_index = find_dimming_duration(smooth, times, times[0])
+    """
+    # Find the indices where the light curve is closest to 0, discarding any prior to earliest_allowed_time
+    zero_crossing_indices = np.where(np.diff(np.signbit(smooth)))[0]
+    zero_crossing_indices = zero_crossing_indices[times[zero_crossing_indices] > earliest_allowed_time]
+
+    # Figure out which way the light curve is sloping through each crossing
+    slopes = smooth[zero_crossing_indices + 1] - smooth[zero_crossing_indices]
+
+    neg_zero_crossing_indices = zero_crossing_indices[slopes < 0]
+    if neg_zero_crossing_indices.size == 0:
+        return None, None
+    neg_zero_crossing_index = neg_zero_crossing_indices[0]
+
+    pos_zero_crossing_indices = zero_crossing_indices[(slopes > 0) & (zero_crossing_indices > neg_zero_crossing_index)]
+    if pos_zero_crossing_indices.size == 0:
+        return neg_zero_crossing_index, None
+
+    return neg_zero_crossing_index, pos_zero_crossing_indices[0]
@@ -12,7 +12,7 @@ __contact__ = 'jmason86@gmail.com'
 
 
 def determine_dimming_slope(light_curve_df,
-                            earliest_allowed_time=None, latest_allowed_time=None, smooth_points=0,
+                            earliest_allowed_time=None, latest_allowed_time=None, smooth_points=0, nan_free=False,
                             plot_path_filename=None):
     """Find the slope of dimming in a light curve, if any.
 
@@ -28,6 +28,9 @@ def determine_dimming_slope(light_curve_df,
                                           Default is None, meaning the end of the light_curve_df.
         smooth_points [integer]:          Used to apply a rolling mean with the number of points (indices) specified.
                                           Default is 0, meaning no smoothing will be performed.
+        nan_free [bool]:                  Set if the caller has already filled any NaNs in light_curve_df so the check for
+                                          them can be skipped. Ignored when smooth_points is set since the rolling mean
+                                          introduces NaNs at the edges. Default is False.
         plot_path_filename [str]:         Set to a path and filename in order to save the summary plot to disk.
                                           Default is None, meaning the plot will not be saved to disk.
 
@@ -62,25 +65,26 @@ def determine_dimming_slope(light_curve_df,
         if jedi_config.verbose:
             jedi_config.logger.info('Applied {0} point smooth.'.format(smooth_points))
 
-    first_non_nan = light_curve_df['irradiance'].first_valid_index()
-    nan_indices = np.isnan(light_curve_df['irradiance'])
-    light_curve_df['irradiance'][nan_indices] = light_curve_df['irradiance'][first_non_nan]
-
-    # Find the max in the allowed window
-    max_time = light_curve_df[earliest_allowed_time:latest_allowed_time]['irradiance'].idxmax()
-    max_irradiance = light_curve_df['irradiance'].loc[max_time]
-    if jedi_config.verbose:
-        jedi_config.logger.info('Maximum in allowed window found with value of {0:.2f} at time {1}'.format(max_irradiance, max_time))
-
-    # Compute the derivative in the time window of interest (inverting sign so that we describe "downward slope")
-    derivative = -light_curve_df[max_time:latest_allowed_time]['irradiance'].diff() / light_curve_df[max_time:latest_allowed_time].index.to_series().diff().dt.total_seconds()
+    # Fill any NaNs with the first valid value
+    if smooth_points or not nan_free:
+        nan_indices = np.isnan(light_curve_df['irradiance'])
+        if nan_indices.any():
+            first_non_nan = light_curve_df['irradiance'].first_valid_index()
+            light_curve_df['irradiance'][nan_indices] = light_curve_df['irradiance'][first_non_nan]
+
+    # Do the number crunching on the raw arrays, with the allowed window (inclusive) converted to indices
+    times = light_curve_df.index.values.view('i8')
+    start_index = np.searchsorted(times, pd.Timestamp(earliest_allowed_time).value, side='left')
+    end_index = np.searchsorted(times, pd.Timestamp(latest_allowed_time).value, side='right')
+    max_index, slope_min, slope_max, slope_mean = find_dimming_slope(light_curve_df['irradiance'].values, times,
+                                                                     start_index, end_index)
+    max_time = light_curve_df.index[max_index]
+    slope_region_df = light_curve_df.iloc[max_index:end_index]
     if jedi_config.verbose:
+        jedi_config.logger.info('Maximum in allowed window found with value of {0:.2f} at time {1}'.format(light_curve_df['irradiance'].values[max_index], max_time))
         jedi_config.logger.info("Computed derivative of light curve within time window of interest.")
 
-    # Get the min, max, and mean slope
-    slope_min = derivative.min()
-    slope_max = derivative.max()
-    slope_mean = derivative.mean()
+    # Format the min, max, and mean slope for the log and plot
     slope_min_str = latex_float(slope_min)
     slope_max_str = latex_float(slope_max)
     slope_mean_str = latex_float(slope_mean)
@@ -101,9 +105,9 @@ def determine_dimming_slope(light_curve_df,
         plt.style.use('jpm-transparent-light')
         from matplotlib import dates
 
+        fig, ax = plt.subplots()
         p = plt.plot(light_curve_df['irradiance'])
-        p = plt.plot(light_curve_df[max_time:latest_allowed_time]['irradiance'], label='slope region')
-        ax = plt.gca()
+        p = plt.plot(slope_region_df['irradiance'], label='slope region')
         plt.axvline(x=earliest_allowed_time, linestyle='dashed', color='grey')
         plt.axvline(x=latest_allowed_time, linestyle='dashed', color='black')
         plt.axvline(x=max_time, linestyle='dashed', color='black')
@@ -132,7 +136,42 @@ def determine_dimming_slope(light_curve_df,
         ax.legend(loc='best')
 
         plt.savefig(plot_path_filename)
+        plt.close(fig)
         if jedi_config.verbose:
             jedi_config.logger.info("Summary plot saved to %s" % plot_path_filename)
 
     return slope_min, slope_max, slope_mean
+
+
+def find_dimming_slope(irradiance, times, start_index, end_index):
+    """Internal-use function to find the downward slope of a light curve array from its max in a window to the window end
+
+    Inputs:
+        irradiance [np.array]: The NaN-free irradiance of the light curve.
+        times [np.array]:      The times of the light curve as int64 nanoseconds, e.g., DatetimeIndex.values.view('i8').
+        start_index [int]:     The first index of the allowed window.
+        end_index [int]:       One past the last index of the allowed window.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        max_index [int]:    The index of the maximum irradiance in the allowed window, where the slope region starts.
+        slope_min [float]:  The minimum slope of dimming in percent/second terms.
+        slope_max [float]:  The maximum slope of dimming in percent/second terms.
+        slope_mean [float]: The mean slope of dimming in percent/second terms.
+
+    Optional Outputs:
+        None
+
+    Example:
+        max_index, slope_min, slope_max, slope_mean = find_dimming_slope(irradiance, times, 0, len(irradiance))
+    """
+    max_index = start_index + np.argmax(irradiance[start_index:end_index])
+
+    # Invert the sign of the derivative so that we describe "downward slope"
+    derivative = -np.diff(irradiance[max_index:end_index]) / (np.diff(times[max_index:end_index]) / 1e9)
+    if derivative.size == 0:
+        return max_index, np.nan, np.nan, np.nan
+
+    return max_index, derivative.min(), derivative.max(), derivative.mean()
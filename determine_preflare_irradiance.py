@@ -1,10 +1,11 @@
 # Standard modules
 import os
+import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import multiprocessing as mp
-import astropy.units as u
+from functools import partial
 
 # Custom modules
 from jpm_number_printing import latex_float
@@ -21,9 +22,11 @@ def determine_preflare_irradiance(light_curve_df, estimated_time_of_peak_start,
                                   plot_path_filename=None):
     """Determine pre-flare irradiance level in a solar light curve.
     Or, more generally, find the pre-peak level in a time series.
+    Every column of light_curve_df is treated as its own light curve, so e.g. all 39 EVE emission lines can be done at once.
 
     Inputs:
         light_curve_df [pd DataFrame]:           A pandas DataFrame with a DatetimeIndex and a column for irradiance.
+                                                 Can instead have one column per light curve, all sharing the same times.
         estimated_time_of_peak_start [metatime]: The estimated time that the dramatic increase starts.
                                                  This could come from, e.g., GOES/XRS.
 
@@ -34,10 +37,12 @@ def determine_preflare_irradiance(light_curve_df, estimated_time_of_peak_start,
         std_threshold [float]:             The maximum allowed standard deviation in the pre-flare windows in percent
                                            terms. The default is 1.0.
         plot_path_filename [str]:          Set to a path and filename in order to save the summary plot to disk.
+                                           Only possible when light_curve_df contains a single light curve.
                                            Default is None, meaning the plot will not be saved to disk.
 
     Outputs:
         preflare_irradiance [float]: The identified pre-flare irradiance level in the same units as light_curve_df.irradiance.
+                                     If light_curve_df has more than one column, this is a np.array with one value per column.
 
     Optional Outputs:
         None.
@@ -50,77 +55,75 @@ def determine_preflare_irradiance(light_curve_df, estimated_time_of_peak_start,
     if jedi_config.verbose:
         jedi_config.logger.info("Running on event with peak start time of {0}.".format(estimated_time_of_peak_start))
 
+    is_single_light_curve = len(light_curve_df.columns) == 1
+    nan_result = np.nan if is_single_light_curve else np.full(len(light_curve_df.columns), np.nan)
+
     # Verify that not all values are nan
     if light_curve_df.isna().all().all():
         if jedi_config.verbose:
             jedi_config.logger.warning("All irradiance values are NaN. Returning.")
-        return np.nan
+        return nan_result
 
     # Verify that the estimated time of the peak isn't before the light curve even starts
     if estimated_time_of_peak_start < light_curve_df.index[0]:
         if jedi_config.verbose:
             jedi_config.logger.warning('The provided estimated_time_of_peak_start: {0} is earlier than the earliest time in the light curve: {1}'.format(estimated_time_of_peak_start, light_curve_df.index[0]))
-        return np.nan
-
-    # Convert irradiance to percent if not already present
-    if 'irradiance_percent' not in light_curve_df.columns:
-        median_irradiance = light_curve_df['irradiance'].median()
-        light_curve_df['irradiance_percent'] = (light_curve_df['irradiance'].values - median_irradiance) / median_irradiance * 100.
-        if jedi_config.verbose:
-            jedi_config.logger.info("Converted irradiance to percent, baselining median in entire pre-flare window.")
+        return nan_result
 
     # Divide the pre-flare period into 3 equal-length windows
     windows = np.array_split(light_curve_df[:estimated_time_of_peak_start], 3)
     if jedi_config.verbose:
         jedi_config.logger.info("Divided pre-flare period into 3 equal-length windows.")
 
-    # Compute median and σ in each window
-    medians = [windowed_df['irradiance_percent'].median() for windowed_df in windows]
-    medians_abs = [windowed_df['irradiance'].median() for windowed_df in windows]
-    stds = np.array([windowed_df['irradiance_percent'].std() for windowed_df in windows])
-    if jedi_config.verbose:
-        jedi_config.logger.info("Computed medians and standard deviations in each window.")
+    # Compute median and σ in each window (rows are windows, columns are light curves)
+    # Percent terms baseline the median in the entire pre-flare window. NaNs are skipped like pandas would, quietly.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median_irradiance = np.nanmedian(light_curve_df.values, axis=0)
+        medians_abs = np.array([np.nanmedian(windowed_df.values, axis=0) for windowed_df in windows])
+        medians = (medians_abs - median_irradiance) / median_irradiance * 100.
+        stds = np.array([np.nanstd(windowed_df.values, axis=0, ddof=1) for windowed_df in windows]) / np.abs(median_irradiance) * 100.
+        if jedi_config.verbose:
+            jedi_config.logger.info("Computed medians and standard deviations in each window.")
 
-    # Compute max difference between the medians
-    max_median_diff = np.max(np.abs(np.append(np.diff(medians), medians[2] - medians[0])))
+        # Compute max difference between the medians
+        max_median_diff = np.max(np.abs(np.vstack([np.diff(medians, axis=0), medians[2] - medians[0]])), axis=0)
 
-    # Compare medians and σs in each window to thresholds
-    failed_median_threshold = False
-    failed_std_threshold = False
-    if np.all(np.isnan(stds)):
-        if jedi_config.verbose:
-            jedi_config.logger.warning('Cannot compute pre-flare irradiance. All standard deviations are nan.')
-        failed_std_threshold = True
-    else:
-        if max_median_diff > max_median_diff_threshold * np.mean(stds):
-            if jedi_config.verbose:
-                jedi_config.logger.warning(
-                    'Cannot compute pre-flare irradiance. Maximum difference in window medians ({0}) exceeded threshold ({1}).'.format(max_median_diff, max_median_diff_threshold * np.mean(stds)))
-            failed_median_threshold = True
-        if (stds < std_threshold).sum() < 2:
-            if jedi_config.verbose:
-                jedi_config.logger.warning('Cannot compute pre-flare irradiance. Standard deviation in more than 1 window is larger than threshold ({0}).'.format(std_threshold))
-            failed_std_threshold = True
+        # Compare medians and σs in each window to thresholds
+        all_stds_nan = np.all(np.isnan(stds), axis=0)
+        failed_median_threshold = ~all_stds_nan & (max_median_diff > max_median_diff_threshold * np.mean(stds, axis=0))
+        failed_std_threshold = all_stds_nan | ((stds < std_threshold).sum(axis=0) < 2)
+
+    if jedi_config.verbose:
+        if all_stds_nan.any():
+            jedi_config.logger.warning('Cannot compute pre-flare irradiance for {0}. All standard deviations are nan.'.format(list(light_curve_df.columns[all_stds_nan])))
+        if failed_median_threshold.any():
+            jedi_config.logger.warning(
+                'Cannot compute pre-flare irradiance for {0}. Maximum difference in window medians exceeded threshold ({1} times the mean of the window standard deviations).'.format(list(light_curve_df.columns[failed_median_threshold]), max_median_diff_threshold))
+        if (failed_std_threshold & ~all_stds_nan).any():
+            jedi_config.logger.warning('Cannot compute pre-flare irradiance for {0}. Standard deviation in more than 1 window is larger than threshold ({1}).'.format(list(light_curve_df.columns[failed_std_threshold & ~all_stds_nan]), std_threshold))
 
     # Compute pre-flare irradiance (mean of the medians in absolute units)
-    if failed_median_threshold or failed_std_threshold:
-        preflare_irradiance = np.nan
-    else:
-        preflare_irradiance = np.mean([windowed_df['irradiance'].median() for windowed_df in windows])
-        if jedi_config.verbose:
-            jedi_config.logger.info("Computed pre-flare irradiance: {0}".format(preflare_irradiance))
+    preflare_irradiance = np.mean(medians_abs, axis=0)
+    preflare_irradiance[failed_median_threshold | failed_std_threshold] = np.nan
+    if jedi_config.verbose:
+        jedi_config.logger.info("Computed pre-flare irradiance: {0}".format(preflare_irradiance))
+
+    if is_single_light_curve:
+        preflare_irradiance = np.nan if np.isnan(preflare_irradiance[0]) else preflare_irradiance[0]
+        medians, medians_abs, stds = medians[:, 0], medians_abs[:, 0], stds[:, 0]
+        median_irradiance, max_median_diff = median_irradiance[0], max_median_diff[0]
+        failed_median_threshold, failed_std_threshold = failed_median_threshold[0], failed_std_threshold[0]
 
     # Produce summary plot
-    if plot_path_filename:
+    if plot_path_filename and is_single_light_curve:
         plt.style.use('jpm-transparent-light')
         from matplotlib import dates
         from matplotlib.patches import Rectangle
 
-        plt.close('all')
-
-        light_curve_df = light_curve_df.drop('irradiance_percent', 1)
+        fig, ax = plt.subplots()
         try:
-            ax = light_curve_df[:estimated_time_of_peak_start].plot(legend=False, c='grey')
+            light_curve_df[:estimated_time_of_peak_start].plot(ax=ax, legend=False, c='grey')
             start_date = light_curve_df.index.values[0]
             start_date_string = pd.to_datetime(str(start_date))
             plt.title('Pre-flare Windows')
@@ -197,30 +200,31 @@ def determine_preflare_irradiance(light_curve_df, estimated_time_of_peak_start,
                 jedi_config.logger.error('{}'.format(error_index))
 
             # Increase border so y-axes don't get cut off in savefig, even though they don't in plt.show()
-            plt.gcf().subplots_adjust(left=0.22)
+            fig.subplots_adjust(left=0.22)
 
             plt.savefig(plot_path_filename)
             if jedi_config.verbose:
                 jedi_config.logger.info("Summary plot for event with start time {0} saved to {1}".format(estimated_time_of_peak_start, plot_path_filename))
         except ValueError as error:
             jedi_config.logger.error('{}'.format(error))
+        plt.close(fig)
 
     return preflare_irradiance
 
 
-def get_preflare_irradiance_all_emission_lines(flare_index):
+def get_preflare_irradiance_all_emission_lines(flare_index, plot_every=0):
     """Loop through all (39) of the EVE extracted emission lines and get the pre-flare irradiance for each
 
         Inputs:
             flare_index [int]: The identifier for which event in JEDI to process.
 
         Optional Inputs:
-            None.
+            plot_every [int]: Set to N to save the per-line summary plots if flare_index % N == 0. Default is 0, meaning no plots.
 
         Outputs:
-            preflare_irradiance [float]: The identified pre-flare irradiance level in the same units as light_curve_df.irradiance.
-            preflare_window_start [str]: The time that the pre-flare irradiance calculation starts.
-            preflare_window_end [str]:   The time that the pre-flare irradiance calculation ends.
+            preflare_irradiance [np.array]: The identified pre-flare irradiance level for each emission line in the same units as light_curve_df.irradiance.
+            preflare_window_start [str]:    The time that the pre-flare irradiance calculation starts.
+            preflare_window_end [str]:      The time that the pre-flare irradiance calculation ends.
 
         Optional Outputs:
             None
@@ -232,33 +236,35 @@ def get_preflare_irradiance_all_emission_lines(flare_index):
         jedi_config.logger.info("Running on event {0}.".format(flare_index))
 
     # Clip EVE data from threshold_time_prior_flare_minutes prior to flare up to peak flare time
-    preflare_window_start = (jedi_config.goes_flare_events['peak_time'][flare_index] - (jedi_config.threshold_time_prior_flare_minutes * u.minute)).iso
-    preflare_window_end = (jedi_config.goes_flare_events['peak_time'][flare_index]).iso
-    eve_lines_preflare_time = jedi_config.eve_lines[preflare_window_start:preflare_window_end]
+    preflare_window_start = jedi_config.preflare_windows_start[flare_index]
+    preflare_window_end = jedi_config.preflare_windows_end[flare_index]
+    eve_lines_preflare_time = jedi_config.clip_eve_lines(preflare_window_start, preflare_window_end)
+
+    estimated_time_of_peak_start = pd.Timestamp(jedi_config.goes_flare_events['start_time'][flare_index].iso)
 
-    # Loop through the emission lines and get pre-flare irradiance for each
-    preflare_irradiance = []
-    for column in eve_lines_preflare_time:
-        eve_line_preflare_time = pd.DataFrame(eve_lines_preflare_time[column])
-        eve_line_preflare_time.columns = ['irradiance']
+    # Get pre-flare irradiance for all emission lines at once
+    preflare_irradiance = determine_preflare_irradiance(eve_lines_preflare_time, estimated_time_of_peak_start)
 
-        preflare_temp = determine_preflare_irradiance(eve_line_preflare_time,
-                                                      pd.Timestamp(jedi_config.goes_flare_events['start_time'][flare_index].iso),
-                                                      plot_path_filename=os.path.join(jedi_config.output_path, 'Preflare Determination', 'Event %d %s.png' % (flare_index, column)))
+    # Summary plots can only be made one emission line at a time
+    if plot_every and flare_index % plot_every == 0:
+        for column in eve_lines_preflare_time:
+            eve_line_preflare_time = pd.DataFrame(eve_lines_preflare_time[column])
+            eve_line_preflare_time.columns = ['irradiance']
 
-        preflare_irradiance.append(preflare_temp)
+            determine_preflare_irradiance(eve_line_preflare_time, estimated_time_of_peak_start,
+                                          plot_path_filename=os.path.join(jedi_config.output_path, 'Preflare Determination', 'Event %d %s.png' % (flare_index, column)))
 
     return preflare_irradiance, preflare_window_start, preflare_window_end
 
 
-def multiprocess_preflare_irradiance():
+def multiprocess_preflare_irradiance(plot_every=0):
     """Multi-threaded processing of pre-flare irradiance across time-independent flares
 
         Inputs:
             preflare_indices [np int array]: The subset of flare_indices that correspond to time-independent flares.
 
         Optional Inputs:
-            None.
+            plot_every [int]: Set to N to save the per-line summary plots for every Nth flare. Default is 0, meaning no plots.
 
         Outputs:
             preflare_irradiance [float]: The identified pre-flare irradiance level in the same units as light_curve_df.irradiance.
@@ -275,11 +281,11 @@ def multiprocess_preflare_irradiance():
         jedi_config.logger.info("Running on {0} events with {1} threads.".format(len(jedi_config.preflare_indices), jedi_config.n_threads))
 
     if jedi_config.n_threads == 1:
-        preflare_irradiances, preflare_windows_start, preflare_windows_end = zip(*map(get_preflare_irradiance_all_emission_lines, jedi_config.preflare_indices))
+        preflare_irradiances, preflare_windows_start, preflare_windows_end = zip(*map(partial(get_preflare_irradiance_all_emission_lines, plot_every=plot_every), jedi_config.preflare_indices))
         jedi_config.logger.info('Preparing export of dataframe.')
     else:
         pool = mp.Pool(processes=jedi_config.n_threads)
-        preflare_irradiances, preflare_windows_start, preflare_windows_end = zip(*pool.map(get_preflare_irradiance_all_emission_lines, jedi_config.preflare_indices))
+        preflare_irradiances, preflare_windows_start, preflare_windows_end = zip(*pool.map(partial(get_preflare_irradiance_all_emission_lines, plot_every=plot_every), jedi_config.preflare_indices))
         pool.close()
         jedi_config.logger.info('Pool closed. Preparing export of dataframe.')
 
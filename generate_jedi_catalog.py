@@ -7,15 +7,17 @@ mpl.use('agg')
 from matplotlib import dates
 import pandas as pd
 import matplotlib.pyplot as plt
-import astropy.units as u
 from astropy.time import Time
 import time
+import multiprocessing as mp
+from functools import partial
+from collections import OrderedDict
 
 # Custom modules
 from jpm_number_printing import latex_float
 from lat_lon_to_position_angle import lat_lon_to_position_angle
 from determine_preflare_irradiance import multiprocess_preflare_irradiance
-from light_curve_peak_match_subtract import light_curve_peak_match_subtract
+from light_curve_peak_match_subtract import detrend_and_find_peak, subtract_matched_peaks, plot_peak_match_subtract
 from light_curve_fit import light_curve_fit
 from determine_dimming_depth import determine_dimming_depth
 from determine_dimming_slope import determine_dimming_slope
@@ -25,14 +27,16 @@ from determine_dimming_duration import determine_dimming_duration
 import jedi_config
 
 # Global variables
-jedi_row = pd.DataFrame()
+jedi_row = OrderedDict()
+preflare_df = pd.DataFrame()
 
 __author__ = 'James Paul Mason'
 __contact__ = 'jmason86@gmail.com'
 
 
 def generate_jedi_catalog(flare_index_range=range(0, 5052),
-                          compute_new_preflare_irradiances=False):
+                          compute_new_preflare_irradiances=False,
+                          plot_every=0):
     """Wrapper code for creating James's Extreme Ultraviolet Variability Experiment (EVE) Dimming Index (JEDI) catalog.
 
     Inputs:
@@ -40,10 +44,13 @@ def generate_jedi_catalog(flare_index_range=range(0, 5052),
 
     Optional Inputs:
         compute_new_preflare_irradiances [bool]: Set to force reprocessing of pre-flare irradiances. Will also occur if preflare file doesn't exist on disk.
+        plot_every [int]:                        Set to N to save processing plots for every Nth flare (flare_index % N == 0).
+                                                 Default is 0, meaning no plots are made. Plotting dominates the runtime so
+                                                 reserve it for debugging or spot checks.
 
     Outputs:
-        No direct return, but writes a csv to disk with the dimming parameterization results.
-        Subroutines also optionally save processing plots to disk in jedi_config.output_path.
+        No direct return, but writes an hdf file to disk with the dimming parameterization results.
+        Subroutines also optionally save processing plots to disk in jedi_config.output_path (see plot_every).
 
     Optional Outputs:
         None
@@ -60,9 +67,8 @@ def generate_jedi_catalog(flare_index_range=range(0, 5052),
     jedi_config.init()
 
     # Define the columns of the JEDI catalog
-    global jedi_row
-    jedi_row = jedi_config.init_jedi_row()
-    jedi_config.write_new_jedi_file_to_disk(jedi_row)
+    global preflare_df
+    jedi_config.write_new_jedi_file_to_disk(jedi_config.init_jedi_row())
 
     if jedi_config.verbose:
         jedi_config.logger.info('Created JEDI row definition.')
@@ -72,103 +78,206 @@ def generate_jedi_catalog(flare_index_range=range(0, 5052),
         jedi_config.logger.info('Recomputing pre-flare irradiances.')
         preflare_irradiances, \
             preflare_windows_start, \
-            preflare_windows_end = multiprocess_preflare_irradiance()
+            preflare_windows_end = multiprocess_preflare_irradiance(plot_every=plot_every)
         jedi_config.logger.info('Finished processing pre-flare irradiances. Writing them to disk.')
         preflare_df = pd.DataFrame()
         preflare_df['Pre-Flare Start Time'] = preflare_windows_start
         preflare_df['Pre-Flare End Time'] = preflare_windows_end
-        preflare_irradiance_column_names = jedi_config.eve_lines.columns + ' Pre-Flare Irradiance [W/m2]'
-        preflare_df = preflare_df.join(pd.DataFrame(columns=preflare_irradiance_column_names))
-        preflare_df[preflare_irradiance_column_names] = preflare_irradiances
+        preflare_df = preflare_df.join(pd.DataFrame(columns=jedi_config.preflare_irradiance_columns))
+        preflare_df[jedi_config.preflare_irradiance_columns] = preflare_irradiances
         preflare_df.to_csv(jedi_config.preflare_csv_filename, index=None, mode='w')
         jedi_config.logger.info('Finished writing pre-flare irradiances to disk.')
     else:
         preflare_df = pd.read_csv(jedi_config.preflare_csv_filename, index_col=None)
 
-    # Start loop through all flares
-    for flare_index in flare_index_range:
-        loop_time = time.time()
+    # Process all flares, spreading them across jedi_config.n_threads processes, and collect the rows here to write in batches
+    if jedi_config.n_threads == 1:
+        write_jedi_rows_in_batches(map(partial(process_flare, plot_every=plot_every), flare_index_range))
+    else:
+        pool = mp.Pool(processes=jedi_config.n_threads, initializer=init_flare_worker, initargs=(preflare_df,))
+        try:
+            write_jedi_rows_in_batches(pool.imap(partial(process_flare, plot_every=plot_every), flare_index_range, chunksize=1))
+        except BaseException:
+            # Don't leave the workers churning through the remaining flares (or hanging on join) after a failure
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        jedi_config.logger.info('Pool closed. All flares processed.')
 
-        # Skip event 0 to avoid problems with referring to earlier indices
-        if flare_index == 0:
-            continue
 
-        jedi_config.logger.info('Running on event {0}'.format(flare_index))
+def init_flare_worker(preflare):
+    """Internal-use function to set up the module state process_flare relies on in each multiprocessing pool worker
+        Forked workers inherit it from the parent anyway, but spawned ones (the default on macOS since Python 3.8 and the
+        only option on Windows) start from a fresh import, so preflare_df is handed over explicitly and jedi_config is
+        loaded if it isn't already.
 
-        # Reinitalize jedi_row (faster and less buggy than setting all values to np.nan)
-        jedi_row = jedi_config.init_jedi_row()
+        Inputs:
+            preflare [pandas DataFrame]: The pre-flare irradiances and windows, as built in generate_jedi_catalog.
 
-        # Fill the GOES flare information into the JEDI row
-        jedi_row['Event #'] = flare_index
-        jedi_row['GOES Flare Start Time'] = jedi_config.goes_flare_events['start_time'][flare_index].iso
-        jedi_row['GOES Flare Peak Time'] = jedi_config.goes_flare_events['peak_time'][flare_index].iso
-        jedi_row['GOES Flare Class'] = jedi_config.goes_flare_events['class'][flare_index]
-        jedi_row['Flare Latitude [deg]'] = jedi_config.goes_flare_events.latitude[flare_index][0]
-        jedi_row['Flare Longitude [deg]'] = jedi_config.goes_flare_events.longitude[flare_index][0]
-        jedi_row['Flare Position Angle [deg]'] = lat_lon_to_position_angle(jedi_row['Flare Latitude [deg]'].values[0], jedi_row['Flare Longitude [deg]'].values[0])
-        if jedi_config.verbose:
-            jedi_config.logger.info("Event {0} GOES flare details stored to JEDI row.".format(flare_index))
+        Optional Inputs:
+            None.
 
-        # Only do pre-parameterization processing if it hasn't been done already (check if files exist on disk)
-        processed_jedi_non_params_filename = jedi_config.output_path + 'Processed Pre-Parameterization Data/Event {0} Pre-Parameterization.h5'.format(flare_index)
-        processed_lines_filename = jedi_config.output_path + 'Processed Lines Data/Event {0} Lines.h5'.format(flare_index)
-        if not os.path.isfile(processed_lines_filename) or not os.path.isfile(processed_jedi_non_params_filename):
-            jedi_row["Pre-Flare Start Time"] = preflare_df['Pre-Flare Start Time'].iloc[map_flare_index_to_preflare_index(flare_index)]
-            jedi_row["Pre-Flare End Time"] = preflare_df['Pre-Flare End Time'].iloc[map_flare_index_to_preflare_index(flare_index)]
-            preflare_irradiance_cols = [col for col in jedi_row.columns if 'Pre-Flare Irradiance' in col]
-            jedi_row[preflare_irradiance_cols] = preflare_df[preflare_irradiance_cols].iloc[map_flare_index_to_preflare_index(flare_index)].values
+        Outputs:
+            No return. Sets the preflare_df global and initializes jedi_config if needed.
 
-            if jedi_config.verbose:
-                jedi_config.logger.info("Event {0} pre-flare irradiances stored to JEDI row.".format(flare_index))
+        Optional Outputs:
+            None.
 
-            # Clip EVE data to dimming window
-            eve_lines_event = clip_eve_data_to_dimming_window(flare_index)
-            if eve_lines_event is False:
-                continue
+        Example:
+            pool = mp.Pool(processes=jedi_config.n_threads, initializer=init_flare_worker, initargs=(preflare_df,))
+    """
+    global preflare_df
+    preflare_df = preflare
+    if jedi_config.eve_lines is None:
+        jedi_config.init()
+        jedi_config.init_jedi_row()
 
-            # Convert irradiance units to percent (in place, don't care about absolute units from this point forward)
-            preflare_irradiances = preflare_df.iloc[map_flare_index_to_preflare_index(flare_index)].filter(regex="\d").values
-            eve_lines_event = (eve_lines_event - preflare_irradiances) / preflare_irradiances * 100.0
 
-            if jedi_config.verbose:
-                jedi_config.logger.info("Event {0} irradiance converted from absolute to percent units.".format(flare_index))
+def write_jedi_rows_in_batches(jedi_rows):
+    """Collect processed rows as they come in and append them to the JEDI catalog on disk every jedi_config.n_flares_per_write flares
 
-            # Do flare removal in the light curves and add the results to the DataFrame
-            time_correction = time.time()
-            loop_light_curve_peak_match_subtract(eve_lines_event, flare_index)
-            print('Time to do peak match subtract [s]: {0}'.format(time.time() - time_correction))
+    Inputs:
+        jedi_rows [iterable]: The outputs of process_flare, in any order.
 
-            # TODO: Update calculate_eve_fe_line_precision to compute for all emission lines, not just selected
-            uncertainty = np.ones(len(eve_lines_event)) * 0.002545
+    Optional Inputs:
+        None.
 
-            # TODO: Propagate uncertainty through light_curve_peak_match_subtract and store in eve_lines_event
+    Outputs:
+        No direct return, but appends to the hdf file on disk. Rows already collected are still written if
+        jedi_rows raises partway through (e.g., a worker failed), so a long run doesn't lose finished flares.
 
-            # Fit the light curves to reduce influence of noise on the parameterizations to come later
-            time_fitting = time.time()
-            loop_light_curve_fit(eve_lines_event, flare_index, uncertainty)
-            print('Time to do fitting [s]: {0}'.format(time.time() - time_fitting))
+    Optional Outputs:
+        None.
 
-            # Save the dimming event data to disk for quicker restore
-            jedi_row.to_hdf(processed_jedi_non_params_filename, 'jedi_row')
-            eve_lines_event.to_hdf(processed_lines_filename, 'eve_lines_event')
-        else:
-            jedi_row = pd.read_hdf(processed_jedi_non_params_filename, 'jedi_row')
-            eve_lines_event = pd.read_hdf(processed_lines_filename, 'eve_lines_event')
-            if jedi_config.verbose:
-                jedi_config.logger.info('Loading files {0} and {1} rather than processing again.'.format(processed_jedi_non_params_filename, processed_lines_filename))
+    Example:
+        write_jedi_rows_in_batches(map(process_flare, flare_index_range))
+    """
+    batch = []
+    batch_number = 0
+    try:
+        for jedi_row_values in jedi_rows:
+            batch.append(jedi_row_values)
+            if len(batch) == jedi_config.n_flares_per_write:
+                jedi_config.append_jedi_rows_to_disk(batch, batch_number)
+                batch = []
+                batch_number += 1
+    finally:
+        if batch:
+            jedi_config.append_jedi_rows_to_disk(batch, batch_number)
+
+
+def process_flare(flare_index, plot_every=0):
+    """Run the full JEDI processing chain for a single flare and return its row
+    Every flare is independent of every other one (pre-flare irradiances are computed up front and looked up), so
+    this can be farmed out to a multiprocessing pool. Only the row values are sent back so the parent process can do
+    all the writing to disk.
 
-        # Parameterize the light curves for dimming
-        determine_dimming_parameters(eve_lines_event, flare_index)
+    Inputs:
+        flare_index [int]: The identifier for which event in JEDI to process.
 
-        # Produce a summary plot for each light curve
-        produce_summary_plot(eve_lines_event, flare_index)
+    Optional Inputs:
+        plot_every [int]: Set to N to save processing plots if flare_index % N == 0. Default is 0, meaning no plots.
+
+    Outputs:
+        jedi_row_values [list]: The dimming parameterization results for this event in jedi_config.jedi_columns order.
+                                Parameters are left NaN if the event couldn't be processed.
+
+    Optional Outputs:
+        None.
+
+    Example:
+        jedi_row_values = process_flare(flare_index)
+    """
+    global jedi_row
+    loop_time = time.time()
+
+    jedi_config.logger.info('Running on event {0}'.format(flare_index))
+
+    make_plots = bool(plot_every) and flare_index % plot_every == 0
+
+    # Reinitalize jedi_row as a plain dict keyed by column name -- a DataFrame is only built when writing to disk
+    jedi_row = OrderedDict.fromkeys(jedi_config.jedi_columns, np.nan)
+
+    # Fill the GOES flare information into the JEDI row
+    jedi_row['Event #'] = flare_index
+    jedi_row['GOES Flare Start Time'] = jedi_config.goes_flare_events['start_time'][flare_index].iso
+    jedi_row['GOES Flare Peak Time'] = jedi_config.goes_flare_events['peak_time'][flare_index].iso
+    jedi_row['GOES Flare Class'] = jedi_config.goes_flare_events['class'][flare_index]
+    jedi_row['Flare Latitude [deg]'] = jedi_config.goes_flare_events.latitude[flare_index][0]
+    jedi_row['Flare Longitude [deg]'] = jedi_config.goes_flare_events.longitude[flare_index][0]
+    jedi_row['Flare Position Angle [deg]'] = lat_lon_to_position_angle(jedi_row['Flare Latitude [deg]'], jedi_row['Flare Longitude [deg]'])
+    if jedi_config.verbose:
+        jedi_config.logger.info("Event {0} GOES flare details stored to JEDI row.".format(flare_index))
+
+    # Flares before the first time-independent one (e.g., event 0) have no pre-flare irradiance to normalize by
+    preflare_index = map_flare_index_to_preflare_index(flare_index)
+    if preflare_index < 0:
+        jedi_config.logger.warning('Event {0} has no time-independent flare at or before it so has no pre-flare irradiance. Skipping parameterization.'.format(flare_index))
+        return list(jedi_row.values())
+
+    # Only do pre-parameterization processing if it hasn't been done already (check if files exist on disk)
+    processed_jedi_non_params_filename = jedi_config.output_path + 'Processed Pre-Parameterization Data/Event {0} Pre-Parameterization.h5'.format(flare_index)
+    processed_lines_filename = jedi_config.output_path + 'Processed Lines Data/Event {0} Lines.h5'.format(flare_index)
+    if not os.path.isfile(processed_lines_filename) or not os.path.isfile(processed_jedi_non_params_filename):
+        preflare_row = preflare_df.iloc[preflare_index]
+        preflare_irradiances = preflare_row[jedi_config.preflare_irradiance_columns].values
+        jedi_row["Pre-Flare Start Time"] = preflare_row['Pre-Flare Start Time']
+        jedi_row["Pre-Flare End Time"] = preflare_row['Pre-Flare End Time']
+        jedi_row.update(zip(jedi_config.preflare_irradiance_columns, preflare_irradiances))
 
-        # Write to the JEDI catalog on disk
-        jedi_row.to_hdf('{0} Event {1}.h5'.format(jedi_config.jedi_hdf_filename, flare_index), key='jedi_row', mode='w')
         if jedi_config.verbose:
-            jedi_config.logger.info('Event {0} JEDI row written to {1}.'.format(jedi_config.jedi_hdf_filename, flare_index))
+            jedi_config.logger.info("Event {0} pre-flare irradiances stored to JEDI row.".format(flare_index))
+
+        # Clip EVE data to dimming window
+        eve_lines_event = clip_eve_data_to_dimming_window(flare_index)
+        if eve_lines_event is False:
+            return list(jedi_row.values())
+
+        # Convert irradiance units to percent (in place, don't care about absolute units from this point forward)
+        preflare_irradiances = np.asarray(preflare_irradiances, dtype=np.float32)
+        eve_lines_event = pd.DataFrame((eve_lines_event.values - preflare_irradiances) / preflare_irradiances * 100.0,
+                                       index=eve_lines_event.index, columns=eve_lines_event.columns)
+
+        if jedi_config.verbose:
+            jedi_config.logger.info("Event {0} irradiance converted from absolute to percent units.".format(flare_index))
+
+        # Do flare removal in the light curves and add the results to the DataFrame
+        time_correction = time.time()
+        eve_lines_event = loop_light_curve_peak_match_subtract(eve_lines_event, flare_index, make_plots=make_plots)
+        print('Time to do peak match subtract [s]: {0}'.format(time.time() - time_correction))
+
+        # TODO: Update calculate_eve_fe_line_precision to compute for all emission lines, not just selected
+        uncertainty = np.full(len(eve_lines_event), 0.002545, dtype=np.float32)
 
-        print('Total time for loop [s]: {0}'.format(time.time() - loop_time))
+        # TODO: Propagate uncertainty through light_curve_peak_match_subtract and store in eve_lines_event
+
+        # Fit the light curves to reduce influence of noise on the parameterizations to come later
+        time_fitting = time.time()
+        loop_light_curve_fit(eve_lines_event, flare_index, uncertainty, make_plots=make_plots)
+        print('Time to do fitting [s]: {0}'.format(time.time() - time_fitting))
+
+        # Save the dimming event data to disk for quicker restore
+        pd.DataFrame([jedi_row]).to_hdf(processed_jedi_non_params_filename, 'jedi_row')
+        eve_lines_event.to_hdf(processed_lines_filename, 'eve_lines_event')
+    else:
+        jedi_row = pd.read_hdf(processed_jedi_non_params_filename, 'jedi_row').iloc[0].to_dict(into=OrderedDict)
+        eve_lines_event = pd.read_hdf(processed_lines_filename, 'eve_lines_event')
+        if jedi_config.verbose:
+            jedi_config.logger.info('Loading files {0} and {1} rather than processing again.'.format(processed_jedi_non_params_filename, processed_lines_filename))
+
+    # Parameterize the light curves for dimming
+    determine_dimming_parameters(eve_lines_event, flare_index, make_plots=make_plots)
+
+    # Produce a summary plot for each light curve
+    if make_plots:
+        produce_summary_plot(eve_lines_event, flare_index)
+
+    print('Total time for loop [s]: {0}'.format(time.time() - loop_time))
+
+    return list(jedi_row.values())
 
 
 def map_flare_index_to_preflare_index(flare_index):
@@ -181,6 +290,7 @@ def map_flare_index_to_preflare_index(flare_index):
     tuneable parameter in jedi_config) we can determine a priori which flares are independent and only compute the
     pre-flare irradiance for those. Thus, the array we end up with is smaller than the total number of flares. This
     function tells you which pre-flare irradiance index to access for the flare index you are currently processing.
+    The mapping for all flares is computed once in jedi_config.init, so this is just a lookup.
     Thanks to Raphael Attie for conceiving of and implementing this logic, which can be easily parallelized and
     processed just a single time to speed up code execution.
 
@@ -192,6 +302,8 @@ def map_flare_index_to_preflare_index(flare_index):
 
     Outputs:
         preflare_index [np.int64]: The index in the pre-flare irradiance array to use for the given flare_index.
+                                   -1 if there is no time-independent flare at or before flare_index, so no
+                                   pre-flare irradiance exists for it.
 
     Optional Outputs:
         None
@@ -199,11 +311,7 @@ def map_flare_index_to_preflare_index(flare_index):
     Example:
         preflare_index = map_flare_index_to_preflare_index(flare_index)
     """
-    is_independent_flare = jedi_config.all_minutes_since_last_flare > jedi_config.threshold_time_prior_flare_minutes
-    all_flare_indices = range(0, is_independent_flare.size)
-    independent_flare_indices = np.where(is_independent_flare)[0]
-    sidx = np.searchsorted(independent_flare_indices, all_flare_indices, 'right') - 1
-    return sidx[flare_index]
+    return jedi_config.preflare_index_of_flare[flare_index]
 
 
 def clip_eve_data_to_dimming_window(flare_index):
@@ -227,46 +335,40 @@ def clip_eve_data_to_dimming_window(flare_index):
     if jedi_config.verbose:
         jedi_config.logger.info("Clipping EVE data in time for event {0}.".format(flare_index))
 
-    flare_interrupt = False
-
-    # Clip EVE data to dimming window
-    bracket_time_left = (jedi_config.goes_flare_events['peak_time'][flare_index] + (jedi_config.dimming_window_relative_to_flare_minutes_left * u.minute))
-    next_flare_time = jedi_config.goes_flare_events['peak_time'][flare_index + 1]
-    user_choice_time = (jedi_config.goes_flare_events['peak_time'][flare_index] + (jedi_config.dimming_window_relative_to_flare_minutes_right * u.minute))
-    bracket_time_right = min(next_flare_time, user_choice_time)
+    # Look up the dimming window, precomputed for all flares in jedi_config.init
+    bracket_time_left = jedi_config.dimming_windows_start[flare_index]
+    bracket_time_right = jedi_config.dimming_windows_end[flare_index]
+    dimming_window_minutes = jedi_config.dimming_windows_minutes[flare_index]
+    flare_interrupt = bool(jedi_config.flare_interrupts[flare_index])
 
-    # If flare is shortening the window, set the flare_interrupt flag
-    if bracket_time_right == next_flare_time:
-        flare_interrupt = True
+    # If flare is shortening the window, the flare_interrupt flag is set
+    if flare_interrupt:
         if jedi_config.verbose:
-            jedi_config.logger.info('Flare interrupt for event at {0} by flare at {1}'.format(jedi_config.goes_flare_events['peak_time'][flare_index].iso, next_flare_time))
+            jedi_config.logger.info('Flare interrupt for event at {0} by flare at {1}'.format(jedi_config.goes_flare_events['peak_time'][flare_index].iso, bracket_time_right))
 
     # Write flare_interrupt to JEDI row
     jedi_row['Flare Interrupt'] = flare_interrupt
 
-    if ((bracket_time_right - bracket_time_left).sec / 60.0) < jedi_config.threshold_minimum_dimming_window_minutes:
-        # Leave all dimming parameters as NaN and write this null result to the disk
-        jedi_row.to_hdf('{0} Event {1}.h5'.format(jedi_config.jedi_hdf_filename, flare_index), key='jedi_row', mode='w')
-
-        # Log message
+    if dimming_window_minutes < jedi_config.threshold_minimum_dimming_window_minutes:
+        # Leave all dimming parameters as NaN so this null result still gets written to the catalog
         if jedi_config.verbose:
             jedi_config.logger.info(
                 'The dimming window duration of {0} minutes is shorter than the minimum threshold of {1} minutes. Skipping this event ({2})'
-                .format(((bracket_time_right - bracket_time_left).sec / 60.0),
+                .format(dimming_window_minutes,
                         jedi_config.threshold_minimum_dimming_window_minutes,
                         jedi_config.goes_flare_events['peak_time'][flare_index]))
 
         eve_lines_event = False
 
     else:
-        eve_lines_event = jedi_config.eve_lines[bracket_time_left.iso:bracket_time_right.iso]
+        eve_lines_event = jedi_config.clip_eve_lines(bracket_time_left, bracket_time_right)
         if jedi_config.verbose:
             jedi_config.logger.info("Event {0} EVE data clipped to dimming window.".format(flare_index))
 
     return eve_lines_event
 
 
-def loop_light_curve_peak_match_subtract(eve_lines_event, flare_index):
+def loop_light_curve_peak_match_subtract(eve_lines_event, flare_index, max_seconds_shift=1800, make_plots=False):
     """Loop through all of the ion permutations, match the pairs of light curves at the flare peak and subtract them
 
     Inputs:
@@ -274,48 +376,97 @@ def loop_light_curve_peak_match_subtract(eve_lines_event, flare_index):
         flare_index [int]:                  The identifier for which event in JEDI to process.
 
     Optional Inputs:
-        None.
+        max_seconds_shift [int]: The maximum allowed time shift in seconds to get the peaks to match.
+        make_plots [bool]:       Set to save a summary plot for every ion permutation. Default is False.
 
     Outputs:
-        No new outputs; appends to eve_lines_event and fills in jedi_row
+        eve_lines_event [pandas DataFrame]: The input with the corrected ion permutation light curves appended as columns.
+                                            Also fills in jedi_row.
 
     Optional Outputs:
         None.
 
     Example:
-        loop_light_curve_peak_match_subtract(eve_lines_event, flare_index)
+        eve_lines_event = loop_light_curve_peak_match_subtract(eve_lines_event, flare_index)
     """
     if jedi_config.verbose:
-        jedi_config.logger.info("Clipping EVE data in time for event {0}.".format(flare_index))
+        jedi_config.logger.info("Peak matching and subtracting ion permutations for event {0}.".format(flare_index))
+
+    estimated_time_of_peak = pd.Timestamp((jedi_config.goes_flare_events['peak_time'][flare_index]).iso)
+
+    # Each emission line shows up in ~76 pairs, so detrend it and find its peak just once up front
+    # rather than for every pair (peakutils can't handle NaNs so drop those first)
+    irradiances = eve_lines_event.values
+    is_finite = np.isfinite(irradiances)
+    line_peaks = []
+    for line_index in range(irradiances.shape[1]):
+        if not is_finite[:, line_index].any():
+            line_peaks.append(None)
+            continue
+        irradiance = irradiances[is_finite[:, line_index], line_index].astype(np.float64)
+        times = eve_lines_event.index[is_finite[:, line_index]]
+        detrended, peak_index = detrend_and_find_peak(irradiance, times, estimated_time_of_peak)
+        line_peaks.append((irradiance, times, detrended, peak_index))
+
+    from_indices = jedi_config.ion_from_indices
+    with_indices = jedi_config.ion_with_indices
 
-    for i in range(len(jedi_config.ion_tuples)):
-        light_curve_to_subtract_from_df = pd.DataFrame(eve_lines_event[jedi_config.ion_tuples[i][0]])
-        light_curve_to_subtract_from_df.columns = ['irradiance']
-        light_curve_to_subtract_with_df = pd.DataFrame(eve_lines_event[jedi_config.ion_tuples[i][1]])
-        light_curve_to_subtract_with_df.columns = ['irradiance']
+    # Fill all of the corrected light curves into one array and attach them at the end instead of inserting 1482 columns
+    light_curves_corrected = np.full((irradiances.shape[0], len(from_indices)), np.nan, dtype=irradiances.dtype)
+    is_corrected = np.zeros(len(from_indices), dtype=bool)
 
-        if (light_curve_to_subtract_from_df.isnull().all().all()) or (light_curve_to_subtract_with_df.isnull().all().all()):
+    for i, ion_permutation in enumerate(jedi_config.ion_permutations):
+        if line_peaks[from_indices[i]] is None or line_peaks[with_indices[i]] is None:
+            if jedi_config.verbose:
+                jedi_config.logger.warning('Event {0} {1} correction skipped because all irradiances are NaN.'.format(flare_index, ion_permutation))
+            continue
+        is_corrected[i] = True
+
+        irradiance_from, times_from, detrend_from, peak_index_from = line_peaks[from_indices[i]]
+        irradiance_with, times_with, _, peak_index_with = line_peaks[with_indices[i]]
+
+        # Check that the two light curves have the same length, i.e. cadence, and that both have a peak
+        # This is to handle the (numerous) cases where MEGS-B cadence is < MEGS-A and vice versa
+        seconds_shift = np.nan
+        scale_factor = np.nan
+        if len(irradiance_from) != len(irradiance_with):
+            if jedi_config.verbose:
+                jedi_config.logger.warning('Event {0} {1} light curves have different length, i.e. cadence. Must skip.'.format(flare_index, ion_permutation))
+        elif peak_index_from is None or peak_index_with is None:
             if jedi_config.verbose:
-                jedi_config.logger.warning(
-                    'Event {0} {1} correction skipped because all irradiances are NaN.'.format(flare_index,
-                                                                                               jedi_config.ion_permutations[i]))
+                jedi_config.logger.warning('Event {0} {1} could not find peak in both light curves.'.format(flare_index, ion_permutation))
         else:
-            light_curve_corrected, seconds_shift, scale_factor = light_curve_peak_match_subtract(light_curve_to_subtract_from_df,
-                                                                                                 light_curve_to_subtract_with_df,
-                                                                                                 pd.Timestamp((jedi_config.goes_flare_events['peak_time'][flare_index]).iso),
-                                                                                                 plot_path_filename=jedi_config.output_path + 'Peak Subtractions/Event {0} {1}.png'.format(flare_index, jedi_config.ion_permutations[i]))
+            seconds_shift = (times_from[peak_index_from] - times_with[peak_index_with]).total_seconds()
+            light_curve_corrected, shifted_scaled_with = None, None
+            if abs(seconds_shift) > max_seconds_shift:
+                if jedi_config.verbose:
+                    jedi_config.logger.warning("Event {0} {1} cannot do peak match. Time shift of {2} seconds is greater than max allowed shift of {3} seconds.".format(flare_index, ion_permutation, seconds_shift, max_seconds_shift))
+            else:
+                light_curve_corrected, shifted_scaled_with, scale_factor = subtract_matched_peaks(irradiance_from, detrend_from, peak_index_from, is_finite[:, from_indices[i]],
+                                                                                                  irradiance_with, peak_index_with, is_finite[:, with_indices[i]])
+                light_curves_corrected[:, i] = light_curve_corrected
 
-            eve_lines_event[jedi_config.ion_permutations[i]] = light_curve_corrected
-            jedi_row[jedi_config.ion_permutations[i] + ' Correction Time Shift [s]'] = seconds_shift
-            jedi_row[jedi_config.ion_permutations[i] + ' Correction Scale Factor'] = scale_factor
+            if make_plots:
+                plot_peak_match_subtract(eve_lines_event.index, times_from, irradiance_from, peak_index_from, times_with, irradiance_with, peak_index_with,
+                                         estimated_time_of_peak, seconds_shift, max_seconds_shift,
+                                         jedi_config.output_path + 'Peak Subtractions/Event {0} {1}.png'.format(flare_index, ion_permutation),
+                                         light_curve_corrected=light_curve_corrected, shifted_scaled_with=shifted_scaled_with,
+                                         scale_factor=scale_factor)
 
-            plt.close('all')
+        jedi_row[ion_permutation + ' Correction Time Shift [s]'] = seconds_shift
+        jedi_row[ion_permutation + ' Correction Scale Factor'] = scale_factor
 
-            if jedi_config.verbose:
-                jedi_config.logger.info('Event {0} flare removal correction complete'.format(flare_index))
+    eve_lines_event = pd.concat([eve_lines_event,
+                                 pd.DataFrame(light_curves_corrected[:, is_corrected], index=eve_lines_event.index,
+                                              columns=jedi_config.ion_permutations[is_corrected])], axis=1)
 
+    if jedi_config.verbose:
+        jedi_config.logger.info('Event {0} flare removal correction complete'.format(flare_index))
+
+    return eve_lines_event
 
-def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty):
+
+def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty, make_plots=False):
     """Loop through all of the light curves for an event (flare_index) and fit them
 
     Inputs:
@@ -324,7 +475,7 @@ def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty):
         uncertainty [numpy array]:          An array containing the uncertainty of each irradiance value. TODO: Needs to be properly populated.
 
     Optional Inputs:
-        None.
+        make_plots [bool]: Set to save the fit plots for every light curve. Default is False.
 
     Outputs:
         No new outputs; appends to eve_lines_event and fills in jedi_row
@@ -338,8 +489,13 @@ def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty):
     if jedi_config.verbose:
         jedi_config.logger.info("Fitting light curves for event {0}.".format(flare_index))
 
+    fitting_path = jedi_config.output_path + 'Fitting/'
+
+    # Find the all-NaN light curves in one pass over the raw array rather than a pandas reduction per column
+    is_all_nan = np.isnan(eve_lines_event.values).all(axis=0)
+
     for i, column in enumerate(eve_lines_event):
-        if eve_lines_event[column].isnull().all().all():
+        if is_all_nan[i]:
             if jedi_config.verbose:
                 jedi_config.logger.info(
                     'Event {0} {1} fitting skipped because all irradiances are NaN.'.format(flare_index, column))
@@ -348,12 +504,9 @@ def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty):
             eve_line_event.columns = ['irradiance']
             eve_line_event['uncertainty'] = uncertainty
 
-            fitting_path = jedi_config.output_path + 'Fitting/'
-
-            plt.close('all')
             light_curve_fit_df, best_fit_gamma, best_fit_score = light_curve_fit(eve_line_event,
                                                                                  gamma=np.array([5e-8]),
-                                                                                 plots_save_path='{0}Event {1} {2}'.format(fitting_path, flare_index, column))
+                                                                                 plots_save_path='{0}Event {1} {2}'.format(fitting_path, flare_index, column) if make_plots else None)
             eve_lines_event[column] = light_curve_fit_df
             jedi_row[column + ' Fitting Gamma'] = best_fit_gamma
             jedi_row[column + ' Fitting Score'] = best_fit_score
@@ -362,7 +515,7 @@ def loop_light_curve_fit(eve_lines_event, flare_index, uncertainty):
                 jedi_config.logger.info('Event {0} {1} light curves fitted.'.format(flare_index, column))
 
 
-def determine_dimming_parameters(eve_lines_event, flare_index):
+def determine_dimming_parameters(eve_lines_event, flare_index, make_plots=False):
     """For every light curve, determine the dimming parameters (depth, slope, duration) wherever possible
 
     Inputs:
@@ -370,7 +523,7 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
         flare_index [int]:                  The identifier for which event in JEDI to process.
 
     Optional Inputs:
-        None.
+        make_plots [bool]: Set to save the depth, slope, and duration plots for every light curve. Default is False.
 
     Outputs:
         No new outputs; appends to eve_lines_event and fills in jedi_row
@@ -384,7 +537,13 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
     if jedi_config.verbose:
         jedi_config.logger.info("Fitting light curves for event {0}.".format(flare_index))
 
-    for column in eve_lines_event:
+    depth_path = jedi_config.output_path + 'Depth/'
+    slope_path = jedi_config.output_path + 'Slope/'
+    duration_path = jedi_config.output_path + 'Duration/'
+
+    is_all_nan = np.isnan(eve_lines_event.values).all(axis=0)
+
+    for i, column in enumerate(eve_lines_event):
         # Null out all parameters
         depth_first, depth_first_time, depth_max, depth_max_time = np.nan, np.nan, np.nan, np.nan
         slope_start_time, slope_end_time = np.nan, np.nan
@@ -392,7 +551,7 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
         duration_seconds, duration_start_time, duration_end_time = np.nan, np.nan, np.nan
 
         # Determine whether to do the parameterizations or not
-        if eve_lines_event[column].isnull().all().all():
+        if is_all_nan[i]:
             if jedi_config.verbose:
                 jedi_config.logger.info(
                     'Event {0} {1} parameterization skipped because all irradiances are NaN.'.format(flare_index,
@@ -401,12 +560,14 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
             eve_line_event = pd.DataFrame(eve_lines_event[column])
             eve_line_event.columns = ['irradiance']
 
-            # Determine dimming depth (if any)
-            depth_path = jedi_config.output_path + 'Depth/'
+            # Fill NaNs once here so depth, slope, and duration all share the same clean light curve and can skip
+            # scanning it for NaNs themselves (nan_free=True)
+            first_valid_irradiance = eve_line_event['irradiance'].loc[eve_line_event['irradiance'].first_valid_index()]
+            eve_line_event['irradiance'] = eve_line_event['irradiance'].fillna(first_valid_irradiance)
 
-            plt.close('all')
-            depth_first, depth_first_time, depth_max, depth_max_time = determine_dimming_depth(eve_line_event,
-                                                                                               plot_path_filename='{0}Event {1} {2} Depth.png'.format(depth_path, flare_index, column))
+            # Determine dimming depth (if any)
+            depth_first, depth_first_time, depth_max, depth_max_time = determine_dimming_depth(eve_line_event, nan_free=True,
+                                                                                               plot_path_filename='{0}Event {1} {2} Depth.png'.format(depth_path, flare_index, column) if make_plots else None)
 
             # Make sure times haven't become NaT instead of NaN
             depth_first_time = valid_time(depth_first_time)
@@ -419,8 +580,6 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
             # jedi_row[column + ' Depth Uncertainty [%]'] = depth_uncertainty  # TODO: make determine_dimming_depth return the propagated uncertainty
 
             # Determine dimming slope (if any)
-            slope_path = jedi_config.output_path + 'Slope/'
-
             slope_start_time = pd.Timestamp((jedi_config.goes_flare_events['peak_time'][flare_index]).iso)
             slope_end_time = depth_first_time
 
@@ -428,11 +587,11 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
                 if jedi_config.verbose:
                     jedi_config.logger.warning('Cannot compute slope or duration because slope bounding times NaN.')
             else:
-                plt.close('all')
                 slope_min, slope_max, slope_mean = determine_dimming_slope(eve_line_event,
                                                                            earliest_allowed_time=slope_start_time,
                                                                            latest_allowed_time=slope_end_time,
-                                                                           plot_path_filename='{0}Event {1} {2} Slope.png'.format(slope_path, flare_index, column))
+                                                                           nan_free=True,
+                                                                           plot_path_filename='{0}Event {1} {2} Slope.png'.format(slope_path, flare_index, column) if make_plots else None)
 
                 # Make sure times haven't become NaT instead of NaN
                 slope_start_time = valid_time(slope_start_time)
@@ -446,12 +605,10 @@ def determine_dimming_parameters(eve_lines_event, flare_index):
                 jedi_row[column + ' Slope End Time'] = slope_end_time
 
                 # Determine dimming duration (if any)
-                duration_path = jedi_config.output_path + 'Duration/'
-
-                plt.close('all')
                 duration_seconds, duration_start_time, duration_end_time = determine_dimming_duration(eve_line_event,
                                                                                                       earliest_allowed_time=slope_start_time,
-                                                                                                      plot_path_filename='{0}Event {1} {2} Duration.png'.format(duration_path, flare_index, column))
+                                                                                                      nan_free=True,
+                                                                                                      plot_path_filename='{0}Event {1} {2} Duration.png'.format(duration_path, flare_index, column) if make_plots else None)
 
                 # Make sure times haven't become NaT instead of NaN
                 duration_start_time = valid_time(duration_start_time)
@@ -495,40 +652,44 @@ def produce_summary_plot(eve_lines_event, flare_index):
     if jedi_config.verbose:
         jedi_config.logger.info("Fitting light curves for event {0}.".format(flare_index))
 
+    summary_path = jedi_config.output_path + 'Summary Plots/'
+
+    is_all_nan = np.isnan(eve_lines_event.values).all(axis=0)
+
     # Produce a summary plot for each light curve
-    for column in eve_lines_event:
-        if eve_lines_event[column].isnull().all().all():
+    for i, column in enumerate(eve_lines_event):
+        if is_all_nan[i]:
             continue
 
         eve_line_event = pd.DataFrame(eve_lines_event[column])
         eve_line_event.columns = ['irradiance']
 
         # Extract the parameters to simplify multiple calls below
-        depth_first = jedi_row[column + ' Depth First [%]'].values[0]
-        depth_first_time = jedi_row[column + ' Depth First Time'].values[0]
-        depth_max = jedi_row[column + ' Depth Max [%]'].values[0]
-        depth_max_time = jedi_row[column + ' Depth Max Time'].values[0]
-        slope_min = jedi_row[column + ' Slope Min [%/s]'].values[0]
-        slope_max = jedi_row[column + ' Slope Max [%/s]'].values[0]
-        slope_mean = jedi_row[column + ' Slope Mean [%/s]'].values[0]
-        slope_start_time = jedi_row[column + ' Slope Start Time'].values[0]
-        slope_end_time = jedi_row[column + ' Slope End Time'].values[0]
-        duration_seconds = jedi_row[column + ' Duration [s]'].values[0]
-        duration_start_time = jedi_row[column + ' Duration Start Time'].values[0]
-        duration_end_time = jedi_row[column + ' Duration End Time'].values[0]
-
-        if type(duration_end_time) is np.datetime64:
+        depth_first = jedi_row[column + ' Depth First [%]']
+        depth_first_time = jedi_row[column + ' Depth First Time']
+        depth_max = jedi_row[column + ' Depth Max [%]']
+        depth_max_time = jedi_row[column + ' Depth Max Time']
+        slope_min = jedi_row[column + ' Slope Min [%/s]']
+        slope_max = jedi_row[column + ' Slope Max [%/s]']
+        slope_mean = jedi_row[column + ' Slope Mean [%/s]']
+        slope_start_time = jedi_row[column + ' Slope Start Time']
+        slope_end_time = jedi_row[column + ' Slope End Time']
+        duration_seconds = jedi_row[column + ' Duration [s]']
+        duration_start_time = jedi_row[column + ' Duration Start Time']
+        duration_end_time = jedi_row[column + ' Duration End Time']
+
+        if pd.notnull(duration_end_time):
             plot_window_end_time = duration_end_time + np.timedelta64(1, 'h')
-        elif type(depth_first_time) is np.datetime64:
+        elif pd.notnull(depth_first_time):
             plot_window_end_time = depth_first_time + np.timedelta64(1, 'h')
         else:
             plot_window_end_time = eve_line_event.index.values[-1]
 
-        plt.close('all')
-        ax = eve_line_event['irradiance'].plot(color='black')
-        plt.xlim(jedi_row['GOES Flare Start Time'].values[0], plot_window_end_time)
+        fig, ax = plt.subplots()
+        eve_line_event['irradiance'].plot(color='black', ax=ax)
+        plt.xlim(jedi_row['GOES Flare Start Time'], plot_window_end_time)
         plt.axhline(linestyle='dashed', color='grey')
-        start_date = jedi_row['GOES Flare Start Time'].values[0]
+        start_date = jedi_row['GOES Flare Start Time']
         start_date_string = pd.to_datetime(str(start_date))
         plt.xlabel(start_date_string.strftime('%Y-%m-%d %H:%M:%S'))
         plt.ylabel('Irradiance [%]')
@@ -576,17 +737,16 @@ def produce_summary_plot(eve_lines_event, flare_index):
             plt.annotate(str(duration_seconds) + ' s', xy=(mid_time, 0), xycoords='data', ha='center', va='bottom',
                          size=18, color='dodgerblue')
 
-        summary_path = jedi_config.output_path + 'Summary Plots/'
         summary_filename = '{0}Event {1} {2} Parameter Summary.png'.format(summary_path, flare_index, column)
         plt.savefig(summary_filename)
-        plt.close('all')
+        plt.close(fig)
 
         if jedi_config.verbose:
             jedi_config.logger.info("Summary plot saved to %s" % summary_filename)
 
 
 def merge_jedi_catalog_files(file_path='/Users/jmason86/Dropbox/Research/Postdoc_NASA/Analysis/Coronal Dimming Analysis/JEDI Catalog/'):
-    """Function for merging the .csv output files of generate_jedi_catalog()
+    """Function for merging the .h5 output files of generate_jedi_catalog()
 
     Inputs:
         None.
@@ -604,19 +764,18 @@ def merge_jedi_catalog_files(file_path='/Users/jmason86/Dropbox/Research/Postdoc
     Example:
         merge_jedi_catalog_files()
     """
-    # Create one sorted, clean dataframe from all of the csv files
+    # Create one sorted, clean dataframe from all of the catalog files
+    # Each generate_jedi_catalog run file holds its rows in batches under separate keys (plus an empty 'jedi' definition
+    # row), so just read every key. Previous merges are skipped since their rows are already in the run files.
     list_dfs = []
-    for file in os.listdir(file_path):
-        #if file.endswith(".h5") and "merged" not in file:
-        if file.endswith(".h5") and "merged" in file:
-            #flare_index = int(file.split()[-1].split('.')[0])
-            #if flare_index >= 2500:  # This is only here because the full JEDI merge is too big to do all at once with only 16 GB of RAM
-            #jedi_rows = pd.read_hdf(os.path.join(file_path, file), 'jedi_row')
-            jedi_rows = pd.read_hdf(os.path.join(file_path, file), 'jedi')
-            list_dfs.append(jedi_rows)
+    for file in sorted(os.listdir(file_path)):
+        if file.startswith('jedi_') and not file.startswith('jedi_merged_') and file.endswith('.h5'):
+            with pd.HDFStore(os.path.join(file_path, file), mode='r') as store:
+                for key in store.keys():
+                    list_dfs.append(store[key])
     jedi_catalog_df = pd.concat(list_dfs, ignore_index=True)
     jedi_catalog_df.dropna(axis=0, how='all', inplace=True)
-    jedi_catalog_df.drop_duplicates(inplace=True)
+    jedi_catalog_df.drop_duplicates(subset=['Event #'], keep='last', inplace=True)  # Reprocessed events keep the newest run
     jedi_catalog_df.sort_values(by=['Event #'], inplace=True)
     jedi_catalog_df.reset_index(drop=True, inplace=True)
     jedi_config.init()
@@ -625,7 +784,7 @@ def merge_jedi_catalog_files(file_path='/Users/jmason86/Dropbox/Research/Postdoc
     jedi_catalog_df = jedi_catalog_df[cols]
     jedi_catalog_df = jedi_catalog_df.apply(pd.to_numeric, errors='ignore')
     if jedi_config.verbose:
-        print("Read files, sorted, dropped empty and duplicate rows, and reset index.")
+        print("Read files, sorted, dropped empty rows and duplicate events, and reset index.")
 
     # Write the catalog to disk
     hdf_filename = file_path + 'jedi_merged_{0}.h5'.format(Time.now().iso)
@@ -1,11 +1,10 @@
 # Standard modules
 import os
 from astropy.time import Time
+import astropy.units as u
 from scipy.io.idl import readsav
 import numpy as np
 import pandas as pd
-from collections import OrderedDict
-import itertools
 
 # Custom modules
 from jpm_logger import JpmLogger
@@ -22,17 +21,31 @@ dimming_window_relative_to_flare_minutes_right = 1440.0
 threshold_minimum_dimming_window_minutes = 120.0
 n_events = 5052
 n_threads = 6  # The number of threads to use when doing parallel processing tasks
+n_flares_per_write = 100  # The number of processed flares to hold in memory before appending them to the JEDI catalog on disk
 verbose = True  # Set to log the processing messages to disk and console.
 
 eve_lines = None
+eve_lines_times = None
 goes_flare_events = None
 logger = None
 jedi_hdf_filename = None
 preflare_csv_filename = None
 all_minutes_since_last_flare = None
 preflare_indices = None
+preflare_index_of_flare = None
+preflare_windows_start = None
+preflare_windows_end = None
+dimming_windows_start = None
+dimming_windows_end = None
+dimming_windows_minutes = None
+flare_interrupts = None
 ion_tuples = None
 ion_permutations = None
+ion_from_indices = None
+ion_with_indices = None
+jedi_columns = None
+is_numeric_jedi_column = None
+preflare_irradiance_columns = None
 
 
 def init():
@@ -49,6 +62,9 @@ def init():
             logger [JpmLogger]:                               A configurable log that can optionally also print to console.
             all_minutes_since_last_flare [numpy float array]: The amount of time between each flare.
             preflare_indices [numpy int array]:               The indices where flares are considered time-independent.
+            preflare_index_of_flare [numpy int array]:        The pre-flare irradiance index to use for each flare index.
+                                                              -1 where no time-independent flare precedes it.
+            Plus the pre-flare and dimming windows of every flare (see init_flare_windows).
 
         Optional Outputs:
              None
@@ -56,7 +72,7 @@ def init():
         Example:
             jedi_config.init()
     """
-    global logger, all_minutes_since_last_flare, preflare_indices
+    global logger, all_minutes_since_last_flare, preflare_indices, preflare_index_of_flare
 
     # Initialize logger
     logger = JpmLogger(filename=logger_filename, path=output_path, console=False)
@@ -75,59 +91,69 @@ def init():
     load_goes_flare_event_data()
 
     # Compute the amount of time between all flares [minutes]
+    # Uses astropy Time differences rather than raw Julian dates so leap seconds (e.g., 2012-06-30) are accounted for
     peak_time = goes_flare_events['peak_time']
-    all_minutes_since_last_flare = (peak_time[1:] - peak_time[0:-1]).sec / 60.0
+    all_minutes_since_last_flare = (peak_time[1:] - peak_time[:-1]).sec / 60.0
 
     # Figure out which flares are independent, store those indices
     is_flare_independent = all_minutes_since_last_flare > threshold_time_prior_flare_minutes
     preflare_indices = np.where(is_flare_independent)[0] + 1  # Add 1 to map back to event index and not to the differentiated vector
     logger.info('Found {0} independent flares of {1} total flares given a time separation of {2} minutes.'.format(len(preflare_indices), len(is_flare_independent), threshold_time_prior_flare_minutes))
 
+    # Map every flare to the pre-flare irradiance it should use (see map_flare_index_to_preflare_index in generate_jedi_catalog)
+    preflare_index_of_flare = map_flares_to_preflare_indices(preflare_indices, is_flare_independent.size + 1)
+
+    # Compute the pre-flare and dimming windows for every flare at once
+    init_flare_windows()
 
-def init_folders():
-    """Internal-use function to check if necessary folders exist; if not, create them
+
+def map_flares_to_preflare_indices(preflare_indices, n_flares):
+    """Internal-use function to find which pre-flare irradiance every flare should use
+        That is the one of the latest time-independent flare at or before it, so counting how many of those there are
+        gives its index in the pre-flare irradiance array.
 
         Inputs:
-            None. Draws from the globals at the top of this file.
+            preflare_indices [numpy int array]: The sorted flare indices that are time-independent.
+            n_flares [int]:                     The total number of flares.
 
         Optional Inputs:
             None.
 
         Outputs:
-            No return. Creates folders on disk.
+            preflare_index_of_flare [numpy int array]: The pre-flare irradiance index to use for each flare index.
+                                                       -1 where no time-independent flare precedes it.
 
         Optional Outputs:
              None.
 
         Example:
-            init_folders()
+            preflare_index_of_flare = map_flares_to_preflare_indices(np.array([3, 5]), 8)  # [-1, -1, -1, 0, 0, 1, 1, 1]
     """
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-
-    if not os.path.exists(output_path + 'Processed Pre-Parameterization Data'):
-        os.makedirs(output_path + 'Processed Pre-Parameterization Data')
+    return np.searchsorted(preflare_indices, np.arange(n_flares), 'right') - 1
 
-    if not os.path.exists(output_path + 'Processed Lines Data'):
-        os.makedirs(output_path + 'Processed Lines Data')
 
-    if not os.path.exists(output_path + 'Peak Subtractions'):
-        os.makedirs(output_path + 'Peak Subtractions')
+def init_folders():
+    """Internal-use function to check if necessary folders exist; if not, create them
 
-    if not os.path.exists(output_path + 'Fitting'):
-        os.makedirs(output_path + 'Fitting')
+        Inputs:
+            None. Draws from the globals at the top of this file.
 
-    if not os.path.exists(output_path + 'Depth'):
-        os.makedirs(output_path + 'Depth')
+        Optional Inputs:
+            None.
 
-    if not os.path.exists(output_path + 'Slope'):
-        os.makedirs(output_path + 'Slope')
+        Outputs:
+            No return. Creates folders on disk.
 
-    if not os.path.exists(output_path + 'Duration'):
-        os.makedirs(output_path + 'Duration')
+        Optional Outputs:
+             None.
 
-    if not os.path.exists(output_path + 'Summary Plots'):
-        os.makedirs(output_path + 'Summary Plots')
+        Example:
+            init_folders()
+    """
+    # Create every output folder once up front so nothing downstream has to check for them in its loops
+    for folder in ['', 'Processed Pre-Parameterization Data', 'Processed Lines Data', 'Preflare Determination',
+                   'Peak Subtractions', 'Fitting', 'Depth', 'Slope', 'Duration', 'Summary Plots']:
+        os.makedirs(os.path.join(output_path, folder), exist_ok=True)
 
 
 def init_filenames():
@@ -152,7 +178,7 @@ def init_filenames():
             init_filenames()
     """
     global jedi_hdf_filename, preflare_csv_filename
-    jedi_hdf_filename = output_path + 'jedi_{0}'.format(Time.now().iso)
+    jedi_hdf_filename = output_path + 'jedi_{0}.h5'.format(Time.now().iso)
     preflare_csv_filename = os.path.join(output_path, 'Preflare Determination/Preflare Irradiances.csv')
 
 
@@ -168,6 +194,7 @@ def load_eve_data():
         Outputs:
             No return. Updates global variables.
             eve_lines [pandas DataFrame]: SDO/EVE level 2 lines data. Stores irradiance, time, and wavelength.
+            eve_lines_times [numpy int64 array]: The eve_lines timestamps in nanoseconds, used by clip_eve_lines.
 
         Optional Outputs:
              None.
@@ -175,20 +202,47 @@ def load_eve_data():
         Example:
             load_eve_data()
     """
-    global eve_lines
+    global eve_lines, eve_lines_times
 
     # TODO: Replace this shortcut method with the method I'm building into sunpy
     logger.info('Loading EVE data.')
     eve_readsav = readsav(eve_data_path)
     irradiance = eve_readsav['irradiance'].byteswap().newbyteorder()  # pandas doesn't like big endian
+    irradiance = irradiance.astype(np.float32, copy=False)  # Keep everything downstream in single precision to halve memory traffic
     irradiance[irradiance == -1] = np.nan
     wavelengths = eve_readsav['wavelength']
-    wavelengths_str = []
-    [wavelengths_str.append('{0:1.1f}'.format(wavelength)) for wavelength in wavelengths]
+    wavelengths_str = ['{0:1.1f}'.format(wavelength) for wavelength in wavelengths]
     eve_lines = pd.DataFrame(irradiance, columns=wavelengths_str)
     eve_lines.index = pd.to_datetime(eve_readsav.iso.astype(str))
     eve_lines.sort_index(inplace=True)
     eve_lines = eve_lines.drop_duplicates()
+    eve_lines_times = eve_lines.index.values.view('i8')
+
+
+def clip_eve_lines(start_time, end_time):
+    """Clip the EVE lines data to a time range with a binary search on the precomputed timestamps
+        Gives the same rows as eve_lines[start_time:end_time] with second-precision iso strings, but skips the
+        overhead of pandas parsing and label-based slicing.
+
+        Inputs:
+            start_time [str]: The iso time to start the clip at (inclusive).
+            end_time [str]:   The iso time to end the clip at (inclusive through the end of that second).
+
+        Optional Inputs:
+            None.
+
+        Outputs:
+            eve_lines_clipped [pandas DataFrame]: The rows of eve_lines within the time range.
+
+        Optional Outputs:
+             None.
+
+        Example:
+            eve_lines_clipped = clip_eve_lines('2010-08-07 17:00:00', '2010-08-07 22:00:00')
+    """
+    start_index, end_index = np.searchsorted(eve_lines_times, [pd.Timestamp(start_time).value,
+                                                               pd.Timestamp(end_time).value + 10**9])
+    return eve_lines.iloc[start_index:end_index]
 
 
 def load_goes_flare_event_data():
@@ -224,6 +278,53 @@ def load_goes_flare_event_data():
     goes_flare_events['start_time'] = Time(goes_flare_events['event_start_time_jd'], format='jd', scale='utc', precision=0)
 
 
+def init_flare_windows():
+    """Internal-use function to compute the pre-flare and dimming time windows for all flares at once
+        Doing this with vectorized astropy Time arithmetic up front is much faster than doing it flare by flare.
+
+        Inputs:
+            None. Draws from the globals set up in init, so goes_flare_events and all_minutes_since_last_flare must exist.
+
+        Optional Inputs:
+            None.
+
+        Outputs:
+            No return. Updates global variables.
+            preflare_windows_start [numpy str array]:    The iso time each flare's pre-flare window starts.
+            preflare_windows_end [numpy str array]:      The iso time each flare's pre-flare window ends (flare peak).
+            dimming_windows_start [numpy str array]:     The iso time each flare's dimming window starts.
+            dimming_windows_end [numpy str array]:       The iso time each flare's dimming window ends, either the user
+                                                         choice or the peak of the next flare, whichever is sooner.
+            dimming_windows_minutes [numpy float array]: The duration of each flare's dimming window.
+            flare_interrupts [numpy bool array]:         True where the next flare cuts the dimming window short.
+
+        Optional Outputs:
+             None.
+
+        Example:
+            init_flare_windows()
+    """
+    global preflare_windows_start, preflare_windows_end, dimming_windows_start, dimming_windows_end, \
+        dimming_windows_minutes, flare_interrupts
+
+    peak_time = goes_flare_events['peak_time']
+    peak_time_iso = peak_time.iso
+
+    preflare_windows_start = (peak_time - (threshold_time_prior_flare_minutes * u.minute)).iso
+    preflare_windows_end = peak_time_iso
+
+    # The last flare has no next flare to interrupt it
+    minutes_until_next_flare = np.append(all_minutes_since_last_flare, np.inf)
+    flare_interrupts = minutes_until_next_flare <= dimming_window_relative_to_flare_minutes_right
+
+    dimming_windows_start = (peak_time + (dimming_window_relative_to_flare_minutes_left * u.minute)).iso
+    next_flare_time_iso = np.append(peak_time_iso[1:], peak_time_iso[-1])
+    user_choice_time_iso = (peak_time + (dimming_window_relative_to_flare_minutes_right * u.minute)).iso
+    dimming_windows_end = np.where(flare_interrupts, next_flare_time_iso, user_choice_time_iso)
+    dimming_windows_minutes = (np.minimum(minutes_until_next_flare, dimming_window_relative_to_flare_minutes_right) -
+                               dimming_window_relative_to_flare_minutes_left)
+
+
 def init_jedi_row():
     """Internal-use function for defining the column headers in the JEDI catalog
 
@@ -235,6 +336,10 @@ def init_jedi_row():
 
         Outputs:
             jedi_row [pandas DataFrame]: A ~24k column DataFrame with only a single row populated with np.nan's.
+            Also updates the globals ion_tuples, ion_permutations, ion_from_indices/ion_with_indices (the eve_lines column
+            index of each half of every ion permutation), jedi_columns (the ordered list of column names),
+            is_numeric_jedi_column (a boolean mask over jedi_columns of the computed parameters that always hold floats), and
+            preflare_irradiance_columns (the pre-flare irradiance column names in eve_lines column order).
 
         Optional Outputs:
              None
@@ -242,62 +347,56 @@ def init_jedi_row():
         Example:
             jedi_row = init_jedi_row()
     """
-    jedi_row = pd.DataFrame([OrderedDict([
-                             ('Event #', np.nan),
-                             ('GOES Flare Start Time', np.nan),
-                             ('GOES Flare Peak Time', np.nan),
-                             ('GOES Flare Class', np.nan),
-                             ('Pre-Flare Start Time', np.nan),
-                             ('Pre-Flare End Time', np.nan),
-                             ('Flare Interrupt', np.nan),
-                             ('Flare Latitude [deg]', np.nan),
-                             ('Flare Longitude [deg]', np.nan),
-                             ('Flare Position Angle [deg]', np.nan)])])
-
     # Define the combination of columns of the JEDI catalog
-    global ion_tuples, ion_permutations
-    ion_tuples = list(itertools.permutations(eve_lines.columns.values, 2))
-    ion_permutations = pd.Index([' by '.join(ion_tuples[i]) for i in range(len(ion_tuples))])
-
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Pre-Flare Irradiance [W/m2]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Min [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Max [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Mean [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Slope Uncertainty [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth First Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth First [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth Max Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth Max [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Depth Uncertainty [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Duration [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Fitting Gamma'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=eve_lines.columns + ' Fitting Score'))
-
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Min [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Max [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Mean [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Slope Uncertainty [%/s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth First Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth First [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth Max Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth Max [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Depth Uncertainty [%]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration Start Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration End Time'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Duration [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Correction Time Shift [s]'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Correction Scale Factor'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Fitting Gamma'))
-    jedi_row = jedi_row.join(pd.DataFrame(columns=ion_permutations + ' Fitting Score'))
-
-    # Force the dtypes to numeric rather than objects
-    jedi_row = jedi_row.apply(pd.to_numeric, errors='ignore')
+    global ion_tuples, ion_permutations, ion_from_indices, ion_with_indices, jedi_columns, is_numeric_jedi_column, preflare_irradiance_columns
+    # Every ordered pair of different lines, i.e., the off-diagonal of a line x line grid, in the same order as itertools.permutations
+    line_names = eve_lines.columns.values.astype(str)
+    ion_from_indices, ion_with_indices = np.nonzero(~np.eye(len(line_names), dtype=bool))
+    ion_tuples = list(zip(line_names[ion_from_indices].tolist(), line_names[ion_with_indices].tolist()))
+    ion_permutations = pd.Index(np.char.add(np.char.add(line_names[ion_from_indices], ' by '), line_names[ion_with_indices]), dtype=object)
+
+    event_columns = ['Event #',
+                     'GOES Flare Start Time',
+                     'GOES Flare Peak Time',
+                     'GOES Flare Class',
+                     'Pre-Flare Start Time',
+                     'Pre-Flare End Time',
+                     'Flare Interrupt',
+                     'Flare Latitude [deg]',
+                     'Flare Longitude [deg]',
+                     'Flare Position Angle [deg]']
+    dimming_parameters = [' Slope Start Time',
+                          ' Slope End Time',
+                          ' Slope Min [%/s]',
+                          ' Slope Max [%/s]',
+                          ' Slope Mean [%/s]',
+                          ' Slope Uncertainty [%/s]',
+                          ' Depth First Time',
+                          ' Depth First [%]',
+                          ' Depth Max Time',
+                          ' Depth Max [%]',
+                          ' Depth Uncertainty [%]',
+                          ' Duration Start Time',
+                          ' Duration End Time',
+                          ' Duration [s]']
+    fitting_parameters = [' Fitting Gamma',
+                          ' Fitting Score']
+    emission_line_parameters = [' Pre-Flare Irradiance [W/m2]'] + dimming_parameters + fitting_parameters
+    ion_permutation_parameters = dimming_parameters + [' Correction Time Shift [s]', ' Correction Scale Factor'] + fitting_parameters
+
+    # Build every column name up front and create the DataFrame in one go rather than joining ~30 times
+    preflare_irradiance_columns = [line + ' Pre-Flare Irradiance [W/m2]' for line in eve_lines.columns]
+    jedi_columns = (event_columns +
+                    [line + parameter for parameter in emission_line_parameters for line in eve_lines.columns] +
+                    [ion_permutation + parameter for parameter in ion_permutation_parameters for ion_permutation in ion_permutations])
+
+    # The per-line and per-permutation parameters other than times are all floats computed in this package, so the catalog
+    # writer can convert those in bulk. The event columns come from elsewhere (e.g., position angle), so leave them to pandas
+    is_numeric_jedi_column = np.array([False] * len(event_columns) +
+                                      [not parameter.endswith(' Time') for parameter in emission_line_parameters for line in eve_lines.columns] +
+                                      [not parameter.endswith(' Time') for parameter in ion_permutation_parameters for ion_permutation in ion_permutations])
+
+    jedi_row = pd.DataFrame(np.full((1, len(jedi_columns)), np.nan), columns=jedi_columns)
 
     return jedi_row
 
@@ -322,3 +421,34 @@ def write_new_jedi_file_to_disk(jedi_row):
                write_new_jedi_file_to_disk(jedi_row)
        """
     jedi_row.to_hdf(jedi_hdf_filename, key='jedi', mode='w')
+
+
+def append_jedi_rows_to_disk(jedi_rows, batch_number):
+    """Append a batch of processed jedi_rows to the JEDI catalog on disk, each batch under its own key
+
+           Inputs:
+               jedi_rows [list]:   The processed rows, each a list of values in jedi_columns order.
+               batch_number [int]: A counter for the batch, used to make its key in the hdf file unique.
+
+           Optional Inputs:
+               None
+
+           Outputs:
+               Appends to the hdf file on disk
+
+           Optional Outputs:
+                None
+
+           Example:
+               append_jedi_rows_to_disk(jedi_rows, 0)
+       """
+    # Convert the float columns as one block instead of letting pandas infer the type of all ~50k columns one at a time
+    jedi_rows = np.array(jedi_rows, dtype=object)
+    columns = pd.Index(jedi_columns)
+    numeric_df = pd.DataFrame(jedi_rows[:, is_numeric_jedi_column].astype(np.float64), columns=columns[is_numeric_jedi_column])
+    other_df = pd.DataFrame(jedi_rows[:, ~is_numeric_jedi_column], columns=columns[~is_numeric_jedi_column])
+    jedi_rows_df = pd.concat([other_df, numeric_df], axis=1)[jedi_columns]
+    batch_key = 'jedi_batch_{0}'.format(batch_number)
+    jedi_rows_df.to_hdf(jedi_hdf_filename, key=batch_key, mode='a')
+    if verbose:
+        logger.info('{0} JEDI rows written to {1} under key {2}.'.format(len(jedi_rows_df), jedi_hdf_filename, batch_key))
@@ -100,11 +100,10 @@ def light_curve_fit(light_curve_df, gamma=np.logspace(-10, -5, num=20, base=10),
         jedi_config.logger.info('Best fit gamma: ' + str(best_fit_gamma))
 
     if plots_save_path and np.size(gamma) > 1:
-        plt.clf()
         plt.style.use('jpm-transparent-light')
+        fig, ax = plt.subplots()
         p1 = plt.plot(gamma, np.median(train_score, 1), label='training score')
         p2 = plt.plot(gamma, np.median(val_score, 1), label='validation score')
-        ax = plt.axes()
         plt.title("t$_0$ = " + datetimeindex_to_human(light_curve_df.index)[0])
         ax.set_xscale('log')
         plt.xlabel('gamma')
@@ -117,6 +116,7 @@ def light_curve_fit(light_curve_df, gamma=np.logspace(-10, -5, num=20, base=10),
         plt.legend(loc='best')
         filename = plots_save_path + 'Validation Curve t0 ' + datetimeindex_to_human(light_curve_df.index)[0] + '.png'
         plt.savefig(filename)
+        plt.close(fig)
         if jedi_config.verbose:
             jedi_config.logger.info("Validation curve saved to %s" % filename)
 
@@ -135,7 +135,7 @@ def light_curve_fit(light_curve_df, gamma=np.logspace(-10, -5, num=20, base=10),
         jedi_config.logger.info("Best model trained and fitted.")
 
     if plots_save_path:
-        plt.clf()
+        fig, ax = plt.subplots()
         plt.errorbar(X.ravel(), y, yerr=uncertainty, color='black', fmt='o', label='Input light curve', zorder=1)
         plt.plot(X.ravel(), y_fit, linewidth=6, label='Fit', zorder=2)
         plt.title("t$_0$ = " + datetimeindex_to_human(light_curve_df.index)[0])
@@ -143,10 +143,11 @@ def light_curve_fit(light_curve_df, gamma=np.logspace(-10, -5, num=20, base=10),
         plt.ylabel('irradiance [%]')
         t1 = plt.text(0.03, 0.03,
                       'fit score = ' + latex_float(best_fit_score),
-                      ha='left', va='bottom', transform=plt.gca().transAxes)
+                      ha='left', va='bottom', transform=ax.transAxes)
         plt.legend(loc='best')
         filename = plots_save_path + 'Fit t0 ' + datetimeindex_to_human(light_curve_df.index)[0] + '.png'
         plt.savefig(filename)
+        plt.close(fig)
         if jedi_config.verbose:
             jedi_config.logger.info("Fitted curve saved to %s" % filename)
 
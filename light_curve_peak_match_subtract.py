@@ -1,6 +1,7 @@
 # Standard modules
 import os
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 
 # Custom modules
@@ -12,15 +13,16 @@ __author__ = 'James Paul Mason'
 __contact__ = 'jmason86@gmail.com'
 
 
-def light_curve_peak_match_subtract(light_curve_to_subtract_from_df, light_curve_to_subtract_with_df, estimated_time_of_peak,
+def light_curve_peak_match_subtract(irradiance_to_subtract_from, irradiance_to_subtract_with, times, estimated_time_of_peak,
                                     max_seconds_shift=1800,
                                     plot_path_filename=None):
     """Align the peak of a second light curve to the first, scale its magnitude to match, and subtract it off.
 
     Inputs:
-        light_curve_to_subtract_from_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex and a column for irradiance.
-        light_curve_to_subtract_with_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex and a column for irradiance.
-        estimated_time_of_peak [metatime]: The estimated time that the peak should occur. This could come from, e.g., GOES/XRS.
+        irradiance_to_subtract_from [np.array]: The irradiance of the light curve to subtract from.
+        irradiance_to_subtract_with [np.array]: The irradiance of the light curve to subtract with.
+        times [pd.DatetimeIndex]:               The times shared by both irradiance arrays.
+        estimated_time_of_peak [metatime]:      The estimated time that the peak should occur. This could come from, e.g., GOES/XRS.
 
     Optional Inputs:
         max_seconds_shift [int]:  The maximum allowed time shift in seconds to get the peaks to match.
@@ -28,73 +30,64 @@ def light_curve_peak_match_subtract(light_curve_to_subtract_from_df, light_curve
                                   Default is None, meaning the plot will not be saved to disk.
 
     Outputs:
-        light_curve_corrected_df [pd DataFrame]: A pandas DataFrame with the same format as light_curve_to_subtract_from_df but
-                                                 with the resultant peak match and subtraction performed. Returns np.nan if
+        light_curve_corrected_df [pd DataFrame]: A pandas DataFrame with a DatetimeIndex (times, minus any where both
+                                                 light curves are NaN) and a column for irradiance with the resultant
+                                                 peak match and subtraction performed. NaN wherever either light curve is.
+                                                 Returns np.nan if the peaks couldn't be found.
+        seconds_shift [float]:                   The number of seconds that irradiance_to_subtract_with was shifted to get
+                                                 its peak to match irradiance_to_subtract_from. Returns np.nan if
                                                  the peaks couldn't be found.
-        seconds_shift [float]:                   The number of seconds that light_curve_to_subtract_with_df was shifted to get
-                                                 its peak to match light_curve_to_subtract_from_df. Returns np.nan if
-                                                 the peaks couldn't be found.
-        scale_factor [float]:                    The multiplicative factor applied to light_curve_to_subtract_with_df to get
-                                                 its peak to match light_curve_to_subtract_from_df. Returns np.nan if
+        scale_factor [float]:                    The multiplicative factor applied to irradiance_to_subtract_with to get
+                                                 its peak to match irradiance_to_subtract_from. Returns np.nan if
                                                  the peaks couldn't be found.
     Optional Outputs:
         None
 
     Example:
-        light_curve_corrected_df, seconds_shift, scale_factor = light_curve_peak_match_subtract(light_curve_to_subtract_from_df,
-                                                                                                light_curve_to_subtract_with_df,
+        light_curve_corrected_df, seconds_shift, scale_factor = light_curve_peak_match_subtract(eve_lines_event['17.1'].values,
+                                                                                                eve_lines_event['28.4'].values,
+                                                                                                eve_lines_event.index,
                                                                                                 estimated_time_of_peak,
                                                                                                 plot_path_filename='./')
     """
     if jedi_config.verbose:
-        jedi_config.logger.info("Running on event with light curve start time of {0}.".format(light_curve_to_subtract_from_df.index[0]))
+        jedi_config.logger.info("Running on event with light curve start time of {0}.".format(times[0]))
 
     # Drop NaNs since peakutils can't handle them
-    light_curve_to_subtract_from_df = light_curve_to_subtract_from_df.dropna()
-    light_curve_to_subtract_with_df = light_curve_to_subtract_with_df.dropna()
+    irradiance_from = np.asarray(irradiance_to_subtract_from, dtype=np.float64)
+    irradiance_with = np.asarray(irradiance_to_subtract_with, dtype=np.float64)
+    finite_from = np.isfinite(irradiance_from)
+    finite_with = np.isfinite(irradiance_with)
+    times_from = times[finite_from]
+    times_with = times[finite_with]
+    irradiance_from = irradiance_from[finite_from]
+    irradiance_with = irradiance_with[finite_with]
 
     # Check that the two input light curves have the same length and return NaN if not
     # This is to handle the (numerous) cases where MEGS-B cadence is < MEGS-A and vice versa
-    if len(light_curve_to_subtract_from_df) != len(light_curve_to_subtract_with_df):
+    if len(irradiance_from) != len(irradiance_with):
         if jedi_config.verbose:
             jedi_config.logger.warning('Input light curves have different length, i.e. cadence. Must skip.')
         return np.nan, np.nan, np.nan
 
-    # Detrend and find the peaks that are ≥ 95% of the max irradiance within
+    # Detrend and find the peaks that are ≥ 95% of the max irradiance within, picking the one closest to the input
+    # estimated peak time (e.g., from GOES/XRS)
     if jedi_config.verbose:
-        jedi_config.logger.info("Detrending light curves.")
-    if (light_curve_to_subtract_from_df['irradiance'].values < 0).all():
-        light_curve_to_subtract_from_df.iloc[0] = 1  # Else can crash peakutils.baseline
-    base_from = peakutils.baseline(light_curve_to_subtract_from_df)
-    detrend_from = light_curve_to_subtract_from_df - base_from
-    indices_from = peakutils.indexes(detrend_from.values.squeeze(), thres=0.95)
-
-    if (light_curve_to_subtract_with_df['irradiance'].values < 0).all():
-        light_curve_to_subtract_with_df.iloc[0] = 1  # Else can crash peakutils.baseline
-    base_with = peakutils.baseline(light_curve_to_subtract_with_df)
-    detrend_with = light_curve_to_subtract_with_df - base_with
-    indices_with = peakutils.indexes(detrend_with.values.squeeze(), thres=0.95)
-
-    if len(indices_from) == 0:
+        jedi_config.logger.info("Detrending light curves and identifying peaks closest to initial guess.")
+    detrend_from, peak_index_from = detrend_and_find_peak(irradiance_from, times_from, estimated_time_of_peak)
+    detrend_with, peak_index_with = detrend_and_find_peak(irradiance_with, times_with, estimated_time_of_peak)
+
+    if peak_index_from is None:
         if jedi_config.verbose:
             jedi_config.logger.warning('Could not find peak in light curve to subtract from.')
         return np.nan, np.nan, np.nan
-    if len(indices_with) == 0:
+    if peak_index_with is None:
         if jedi_config.verbose:
             jedi_config.logger.warning('Could not find peak in light curve to subtract with.')
         return np.nan, np.nan, np.nan
 
-    # Identify the peak closest to the input estimated peak time (e.g., from GOES/XRS)
-    if jedi_config.verbose:
-        jedi_config.logger.info("Identifying peaks closest to initial guess in light curves.")
-    peak_index_from = indices_from[closest(light_curve_to_subtract_from_df.index[indices_from], estimated_time_of_peak)]
-    peak_index_with = indices_with[closest(light_curve_to_subtract_with_df.index[indices_with], estimated_time_of_peak)]
-    peak_time_from = light_curve_to_subtract_from_df.index[peak_index_from]
-    index_shift = peak_index_from - peak_index_with
-
     # Compute how many seconds the time shift corresponds to
-    seconds_shift = (light_curve_to_subtract_from_df.index[peak_index_from] -
-                     light_curve_to_subtract_with_df.index[peak_index_with]).total_seconds()
+    seconds_shift = (times_from[peak_index_from] - times_with[peak_index_with]).total_seconds()
 
     # Fail if seconds_shift > max_seconds_shift
     isTimeShiftValid = True
@@ -103,67 +96,193 @@ def light_curve_peak_match_subtract(light_curve_to_subtract_from_df, light_curve
             jedi_config.logger.warning("Cannot do peak match. Time shift of {0} seconds is greater than max allowed shift of {1} seconds.".format(seconds_shift, max_seconds_shift))
         isTimeShiftValid = False
 
-    # Shift the subtract_with light curve in time to align its peak to the subtract_from light curve
+    # Shift the subtract_with light curve in time to align its peak to the subtract_from light curve, scale it, and subtract
+    light_curve_corrected, shifted_scaled_with, scale_factor = None, None, None
     if isTimeShiftValid:
         if jedi_config.verbose:
             jedi_config.logger.info("Shifting and scaling the light curve to subtract with.")
-        shifted_with = light_curve_to_subtract_with_df.shift(index_shift)
-
-        # Scale the subtract_with light curve peak irradiance to match the subtract_from light curve peak irradiance
-        scale_factor = (detrend_from.values[peak_index_from] / shifted_with.values[peak_index_with + index_shift])[0]
-        shifted_scaled_with = shifted_with * scale_factor
-        light_curve_corrected_df = light_curve_to_subtract_from_df - shifted_scaled_with
+        light_curve_corrected, shifted_scaled_with, scale_factor = subtract_matched_peaks(irradiance_from, detrend_from, peak_index_from, finite_from,
+                                                                                          irradiance_with, peak_index_with, finite_with)
+        finite_either = finite_from | finite_with
+        light_curve_corrected_df = pd.DataFrame({'irradiance': light_curve_corrected[finite_either]}, index=times[finite_either])
 
         if jedi_config.verbose:
-            if light_curve_corrected_df.isnull().values.sum() > 1:
-                jedi_config.logger.warning("%s points were shifted to become NaN." % light_curve_corrected_df.isnull().values.sum())
+            n_nan = light_curve_corrected_df['irradiance'].isnull().sum()
+            if n_nan > 1:
+                jedi_config.logger.warning("%s points were shifted to become NaN." % n_nan)
             jedi_config.logger.info("Light curve peak matching and subtraction complete.")
 
     if plot_path_filename:
-        from jpm_number_printing import latex_float
-        seconds_shift_string = '+' if seconds_shift >= 0 else ''
-        seconds_shift_string += str(int(seconds_shift))
-        if isTimeShiftValid:
-            scale_factor_string = latex_float(scale_factor)
-
-        plt.style.use('jpm-transparent-light')
-        from matplotlib import dates
-
-        plt.clf()
-        fig, ax = plt.subplots()
-        plt.plot(light_curve_to_subtract_from_df.index.values, light_curve_to_subtract_from_df.values, c='limegreen')
-        plt.tick_params(axis='x', which='minor', labelbottom='off')
-        plt.xlabel(estimated_time_of_peak)
-        plt.ylabel('Irradiance [%]')
-        fmtr = dates.DateFormatter("%H:%M:%S")
-        ax.xaxis.set_major_formatter(fmtr)
-        ax.xaxis.set_major_locator(dates.HourLocator())
-
-        if isTimeShiftValid:
-            plt.title('I: $\\times$' + scale_factor_string + ', t: ' + seconds_shift_string + ' s', color='tomato')
-            shifted_scaled_with.plot(c='tomato', label='subtract with', ax=ax)
-            light_curve_corrected_df.plot(c='darkgrey', label='result', ax=ax)
-        else:
-            plt.title('t: ' + seconds_shift_string + ' s > max allowed {0} s'.format(max_seconds_shift), color='tomato')
-            plt.plot(light_curve_to_subtract_with_df.index.values, light_curve_to_subtract_with_df.values, c='tomato')
-        plt.scatter(light_curve_to_subtract_from_df.index[peak_index_from], light_curve_to_subtract_from_df.values[peak_index_from], c='black')
-
-        if isTimeShiftValid:
-            plt.scatter(shifted_scaled_with.index[peak_index_with + index_shift], shifted_scaled_with.values[peak_index_with + index_shift], c='black')
-            ax.legend(['subtract from', 'subtract with', 'result'], loc='best')
-        else:
-            plt.scatter(light_curve_to_subtract_with_df.index[peak_index_with], light_curve_to_subtract_with_df.values[peak_index_with], c='black')
-            ax.legend(['subtract from', 'subtract with'], loc='best')
-
-        path = os.path.dirname(plot_path_filename)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        plt.savefig(plot_path_filename)
-
-        if jedi_config.verbose:
-            jedi_config.logger.info("Summary plot saved to %s" % plot_path_filename)
+        # The pipeline creates its folders up front in jedi_config.init_folders, but standalone callers may not have
+        os.makedirs(os.path.dirname(plot_path_filename) or '.', exist_ok=True)
+        plot_peak_match_subtract(times, times_from, irradiance_from, peak_index_from, times_with, irradiance_with, peak_index_with,
+                                 estimated_time_of_peak, seconds_shift, max_seconds_shift, plot_path_filename,
+                                 light_curve_corrected=light_curve_corrected, shifted_scaled_with=shifted_scaled_with,
+                                 scale_factor=scale_factor)
 
     if isTimeShiftValid:
         return light_curve_corrected_df, seconds_shift, scale_factor
     else:
         return np.nan, seconds_shift, np.nan
+
+
+def detrend_and_find_peak(irradiance, times, estimated_time_of_peak):
+    """Internal-use function to remove the baseline trend from a light curve and find its peak closest to an estimated time
+
+    Inputs:
+        irradiance [np.array]:              The irradiance of the light curve, with no NaNs since peakutils can't handle them.
+                                            Note that the first value gets set to 1 if all values are negative.
+        times [pd.DatetimeIndex]:           The times corresponding to irradiance.
+        estimated_time_of_peak [metatime]:  The estimated time that the peak should occur. This could come from, e.g., GOES/XRS.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        detrended [np.array]: The irradiance with the peakutils baseline subtracted off.
+        peak_index [int]:     The index of the peak (≥ 95% of the detrended max) closest to estimated_time_of_peak.
+                              None if no peak could be found.
+
+    Optional Outputs:
+        None
+
+    Example:
+        detrended, peak_index = detrend_and_find_peak(irradiance, times, estimated_time_of_peak)
+    """
+    if (irradiance < 0).all():
+        irradiance[0] = 1  # Else can crash peakutils.baseline
+    detrended = irradiance - peakutils.baseline(irradiance)
+    indices = peakutils.indexes(detrended, thres=0.95)
+
+    if len(indices) == 0:
+        return detrended, None
+
+    peak_index = indices[closest(times[indices], estimated_time_of_peak)]
+    return detrended, peak_index
+
+
+def subtract_matched_peaks(irradiance_from, detrend_from, peak_index_from, finite_from,
+                           irradiance_with, peak_index_with, finite_with):
+    """Internal-use function to shift a light curve so its peak lines up with another, scale it to match, and subtract it off
+
+    Inputs:
+        irradiance_from [np.array]: The (finite) irradiance of the light curve to subtract from.
+        detrend_from [np.array]:    The detrended irradiance of the light curve to subtract from.
+        peak_index_from [int]:      The index of the peak in the light curve to subtract from.
+        finite_from [np.array]:     Boolean mask of where irradiance_from sits on the time grid shared by both light curves.
+        irradiance_with [np.array]: The (finite) irradiance of the light curve to subtract with. Must be the same length as irradiance_from.
+        peak_index_with [int]:      The index of the peak in the light curve to subtract with.
+        finite_with [np.array]:     Boolean mask of where irradiance_with sits on the shared time grid.
+
+    Optional Inputs:
+        None
+
+    Outputs:
+        light_curve_corrected [np.array]: On the shared time grid, irradiance_from with the shifted, scaled irradiance_with
+                                          subtracted off. NaN wherever either light curve has no value.
+        shifted_scaled_with [np.array]:   On the shared time grid, irradiance_with after shifting and scaling. Points shifted
+                                          in from outside are NaN.
+        scale_factor [float]:             The multiplicative factor applied to irradiance_with to match the peaks.
+
+    Optional Outputs:
+        None
+
+    Example:
+        light_curve_corrected, shifted_scaled_with, scale_factor = subtract_matched_peaks(irradiance_from, detrend_from, peak_index_from, finite_from,
+                                                                                          irradiance_with, peak_index_with, finite_with)
+    """
+    # Shift by samples of the subtract_with light curve itself, like pandas shift on its NaN-dropped DataFrame
+    index_shift = peak_index_from - peak_index_with
+
+    shifted_with = np.full_like(irradiance_with, np.nan)
+    if index_shift >= 0:
+        shifted_with[index_shift:] = irradiance_with[:len(irradiance_with) - index_shift]
+    else:
+        shifted_with[:index_shift] = irradiance_with[-index_shift:]
+
+    scale_factor = detrend_from[peak_index_from] / shifted_with[peak_index_from]
+
+    # Put both back on the shared time grid before subtracting so they line up by time, not by position -- the two light
+    # curves can have NaNs in different places even when they have the same number of valid points
+    shifted_scaled_with = np.full(finite_with.shape, np.nan)
+    shifted_scaled_with[finite_with] = shifted_with * scale_factor
+    irradiance_from_on_grid = np.full(finite_from.shape, np.nan)
+    irradiance_from_on_grid[finite_from] = irradiance_from
+
+    return irradiance_from_on_grid - shifted_scaled_with, shifted_scaled_with, scale_factor
+
+
+def plot_peak_match_subtract(times, times_from, irradiance_from, peak_index_from, times_with, irradiance_with, peak_index_with,
+                             estimated_time_of_peak, seconds_shift, max_seconds_shift, plot_path_filename,
+                             light_curve_corrected=None, shifted_scaled_with=None, scale_factor=None):
+    """Internal-use function to make the summary plot of a light curve peak match and subtraction
+
+    Inputs:
+        times [pd.DatetimeIndex]:          The time grid shared by both light curves.
+        times_from [pd.DatetimeIndex]:     The times of the light curve to subtract from.
+        irradiance_from [np.array]:        The irradiance of the light curve to subtract from.
+        peak_index_from [int]:             The index of the peak in the light curve to subtract from.
+        times_with [pd.DatetimeIndex]:     The times of the light curve to subtract with.
+        irradiance_with [np.array]:        The irradiance of the light curve to subtract with.
+        peak_index_with [int]:             The index of the peak in the light curve to subtract with.
+        estimated_time_of_peak [metatime]: The estimated time that the peak should occur. Used to label the x-axis.
+        seconds_shift [float]:             The number of seconds between the two peaks.
+        max_seconds_shift [int]:           The maximum allowed time shift in seconds to get the peaks to match.
+        plot_path_filename [str]:          The path and filename to save the summary plot to.
+
+    Optional Inputs:
+        light_curve_corrected [np.array]: The output of subtract_matched_peaks, on times. Default is None, meaning the time shift
+                                          was invalid and no subtraction was done.
+        shifted_scaled_with [np.array]:   The output of subtract_matched_peaks, on times. Default is None, as above.
+        scale_factor [float]:             The output of subtract_matched_peaks. Default is None, as above.
+
+    Outputs:
+        No direct return, but writes the plot to plot_path_filename.
+
+    Optional Outputs:
+        None
+
+    Example:
+        plot_peak_match_subtract(times, times_from, irradiance_from, peak_index_from, times_with, irradiance_with, peak_index_with,
+                                 estimated_time_of_peak, seconds_shift, 1800, './peak_match_subtract.png')
+    """
+    from jpm_number_printing import latex_float
+    from matplotlib import dates
+
+    isTimeShiftValid = light_curve_corrected is not None
+    seconds_shift_string = '+' if seconds_shift >= 0 else ''
+    seconds_shift_string += str(int(seconds_shift))
+
+    plt.style.use('jpm-transparent-light')
+
+    fig, ax = plt.subplots()
+    plt.plot(times_from.values, irradiance_from, c='limegreen')
+    plt.tick_params(axis='x', which='minor', labelbottom='off')
+    plt.xlabel(estimated_time_of_peak)
+    plt.ylabel('Irradiance [%]')
+    fmtr = dates.DateFormatter("%H:%M:%S")
+    ax.xaxis.set_major_formatter(fmtr)
+    ax.xaxis.set_major_locator(dates.HourLocator())
+
+    if isTimeShiftValid:
+        plt.title('I: $\\times$' + latex_float(scale_factor) + ', t: ' + seconds_shift_string + ' s', color='tomato')
+        pd.DataFrame({'irradiance': shifted_scaled_with}, index=times).plot(c='tomato', label='subtract with', ax=ax)
+        pd.DataFrame({'irradiance': light_curve_corrected}, index=times).plot(c='darkgrey', label='result', ax=ax)
+    else:
+        plt.title('t: ' + seconds_shift_string + ' s > max allowed {0} s'.format(max_seconds_shift), color='tomato')
+        plt.plot(times_with.values, irradiance_with, c='tomato')
+    plt.scatter(times_from[peak_index_from], irradiance_from[peak_index_from], c='black')
+
+    if isTimeShiftValid:
+        # The shifted peak now sits at the same sample index as the peak it was matched to
+        plt.scatter(times_with[peak_index_from], irradiance_with[peak_index_with] * scale_factor, c='black')
+        ax.legend(['subtract from', 'subtract with', 'result'], loc='best')
+    else:
+        plt.scatter(times_with[peak_index_with], irradiance_with[peak_index_with], c='black')
+        ax.legend(['subtract from', 'subtract with'], loc='best')
+
+    plt.savefig(plot_path_filename)
+    plt.close(fig)
+
+    if jedi_config.verbose:
+        jedi_config.logger.info("Summary plot saved to %s" % plot_path_filename)
@@ -1,7 +1,9 @@
 import jedi_config
+import numpy as np
 import pandas as pd
 from astropy.time import Time
 import astropy.units as u
+from light_curve_peak_match_subtract import detrend_and_find_peak
 
 jedi_config.init()  # Takes about 60 seconds
 
@@ -28,3 +30,39 @@ def make_preflare_light_curve():
     light_curve = pd.DataFrame(jedi_config.eve_lines.loc[preflare_start_time:flare_peak_time, '17.1'])
     light_curve.columns = ['irradiance']
     return light_curve
+
+
+def make_preflare_light_curves():
+    flare_peak_time = '2010-08-07 18:24:00'
+    preflare_start_time = (Time(flare_peak_time, precision=0) - (jedi_config.threshold_time_prior_flare_minutes * u.minute)).iso
+    return jedi_config.eve_lines.loc[preflare_start_time:flare_peak_time]
+
+
+def make_synthetic_light_curves(peak_time, nan_rows_from=(), nan_rows_with=()):
+    times = pd.date_range(pd.Timestamp(peak_time) - pd.Timedelta(hours=2), periods=360, freq='min')
+    minutes = np.arange(len(times), dtype=np.float64)
+    irradiance_from = 10.0 * np.exp(-0.5 * ((minutes - 120) / 8.0)**2) + 0.01 * minutes + 0.1 * np.sin(minutes) + 1.0
+    irradiance_with = 4.0 * np.exp(-0.5 * ((minutes - 123) / 8.0)**2) + 0.02 * minutes + 0.1 * np.cos(minutes) + 1.0
+    irradiance_from[list(nan_rows_from)] = np.nan
+    irradiance_with[list(nan_rows_with)] = np.nan
+    return pd.Series(irradiance_from, index=times), pd.Series(irradiance_with, index=times)
+
+
+def label_aligned_peak_match_subtract(light_curve_from, light_curve_with, estimated_time_of_peak, max_seconds_shift=1800):
+    """The original pandas arithmetic of light_curve_peak_match_subtract: shift within the NaN-dropped light curve to subtract
+    with, then subtract aligned by timestamp. Returns None wherever the original returned np.nan for the corrected light curve."""
+    light_curve_from = light_curve_from.dropna()
+    light_curve_with = light_curve_with.dropna()
+    if len(light_curve_from) != len(light_curve_with):
+        return None, np.nan
+
+    detrend_from, peak_index_from = detrend_and_find_peak(light_curve_from.values.astype(np.float64), light_curve_from.index, estimated_time_of_peak)
+    _, peak_index_with = detrend_and_find_peak(light_curve_with.values.astype(np.float64), light_curve_with.index, estimated_time_of_peak)
+    if peak_index_from is None or peak_index_with is None:
+        return None, np.nan
+    if abs((light_curve_from.index[peak_index_from] - light_curve_with.index[peak_index_with]).total_seconds()) > max_seconds_shift:
+        return None, np.nan
+
+    shifted_with = light_curve_with.shift(peak_index_from - peak_index_with)
+    scale_factor = detrend_from[peak_index_from] / shifted_with.values[peak_index_from]
+    return light_curve_from - shifted_with * scale_factor, scale_factor
@@ -1,5 +1,5 @@
 from make_light_curve import make_light_curve, normalized_irradiance_in_percent_units
-from determine_dimming_depth import determine_dimming_depth
+from determine_dimming_depth import determine_dimming_depth, find_dimming_depth
 import numpy as np
 from numpy.testing import assert_approx_equal
 import pandas as pd
@@ -49,3 +49,21 @@ def late_cutoff_works(light_curve):
     assert time_first == pd.Timestamp('2010-08-07 19:15:11')
     assert_approx_equal(depth_max, 0.841, significant=3)
     assert time_max == pd.Timestamp('2010-08-07 19:15:11')
+
+
+def test_find_dimming_depth():
+    minima_indices, depth_first_index, depth_max_index = find_dimming_depth(np.array([0.0, -1.0, 0.0, -3.0, -2.0, -4.0, 0.0]))
+    assert list(minima_indices) == [1, 3, 5]
+    assert depth_first_index == 1
+    assert depth_max_index == 5
+
+    # No minima below 0
+    minima_indices, depth_first_index, depth_max_index = find_dimming_depth(np.array([0.0, 1.0, 0.5, 2.0, 1.5, 3.0]))
+    assert list(minima_indices) == [2, 4]
+    assert depth_first_index is None
+    assert depth_max_index is None
+
+    # Flat bottoms aren't strict minima, same as scipy.signal.argrelmin
+    minima_indices, depth_first_index, depth_max_index = find_dimming_depth(np.array([0.0, -1.0, -1.0, 0.0]))
+    assert minima_indices.size == 0
+    assert depth_first_index is None
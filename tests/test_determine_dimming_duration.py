@@ -1,5 +1,5 @@
 from make_light_curve import make_light_curve, normalized_irradiance_in_percent_units
-from determine_dimming_duration import determine_dimming_duration
+from determine_dimming_duration import determine_dimming_duration, find_dimming_duration
 import numpy as np
 import pandas as pd
 
@@ -47,3 +47,20 @@ def selects_first_subsequent_positive_zero_crossing(light_curve):
             (duration_start_time == pd.Timestamp('2010-08-07 18:59:11')) and \
             (duration_end_time == pd.Timestamp('2010-08-07 21:55:11')):
         return True
+
+
+def test_find_dimming_duration():
+    times = np.arange(5, dtype=np.int64) * 10**9  # 1 second cadence in nanoseconds
+    neg_zero_crossing_index, pos_zero_crossing_index = find_dimming_duration(np.array([1.0, -1.0, -2.0, 1.0, 2.0]), times, -1)
+    assert neg_zero_crossing_index == 0
+    assert pos_zero_crossing_index == 2
+
+    # Negative crossing with no positive crossing after it
+    neg_zero_crossing_index, pos_zero_crossing_index = find_dimming_duration(np.array([1.0, -1.0, -2.0, -1.0, -0.5]), times, -1)
+    assert neg_zero_crossing_index == 0
+    assert pos_zero_crossing_index is None
+
+    # Crossings at or before the earliest allowed time are ignored
+    neg_zero_crossing_index, pos_zero_crossing_index = find_dimming_duration(np.array([1.0, -1.0, -2.0, 1.0, 2.0]), times, times[0])
+    assert neg_zero_crossing_index is None
+    assert pos_zero_crossing_index is None
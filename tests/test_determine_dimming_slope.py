@@ -1,5 +1,6 @@
 from make_light_curve import make_light_curve, normalized_irradiance_in_percent_units
-from determine_dimming_slope import determine_dimming_slope
+from determine_dimming_slope import determine_dimming_slope, find_dimming_slope
+import numpy as np
 from numpy.testing import assert_approx_equal
 import pandas as pd
 
@@ -40,3 +41,17 @@ class TestSlope:
         assert_approx_equal(slope_min, -1.92e-4, significant=3)
         assert_approx_equal(slope_max, 5.48e-4, significant=3)
         assert_approx_equal(slope_mean, 1.91e-4, significant=3)
+
+
+def test_find_dimming_slope():
+    times = np.arange(5, dtype=np.int64) * 10**9  # 1 second cadence in nanoseconds
+    max_index, slope_min, slope_max, slope_mean = find_dimming_slope(np.array([0.0, 2.0, 1.0, -1.0, 5.0]), times, 0, 4)
+    assert max_index == 1
+    assert slope_min == 1.0
+    assert slope_max == 2.0
+    assert slope_mean == 1.5
+
+    # Max at the end of the window leaves no slope region
+    max_index, slope_min, slope_max, slope_mean = find_dimming_slope(np.array([0.0, 1.0, 2.0, 3.0, 0.0]), times, 0, 4)
+    assert max_index == 3
+    assert np.isnan(slope_min) and np.isnan(slope_max) and np.isnan(slope_mean)
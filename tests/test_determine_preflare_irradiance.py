@@ -1,15 +1,16 @@
-from make_light_curve import make_preflare_light_curve, normalized_irradiance_in_percent_units
+from make_light_curve import make_preflare_light_curve, make_preflare_light_curves, normalized_irradiance_in_percent_units
 import jedi_config
 from determine_preflare_irradiance import determine_preflare_irradiance
 import pandas as pd
 import numpy as np
-from numpy.testing import assert_approx_equal
+from numpy.testing import assert_approx_equal, assert_allclose
 
 
 class TestBaselineDetermination:
 
     def test_baseline_determination(self):
         self.light_curve = make_preflare_light_curve()
+        self.light_curves = make_preflare_light_curves()
         jedi_config.threshold_time_prior_flare_minutes = 480.0
         self.flare_peak_time = pd.Timestamp('2010-08-07 18:24:00')
 
@@ -17,10 +18,12 @@ class TestBaselineDetermination:
         self.low_median_diff_threshold_fails()
         self.low_std_threshold_fails()
         self.too_early_time_of_peak_start_fails()
+        self.multiple_light_curves_match_single_light_curves()
 
     def nominal_case_returns_expected_values(self):
         preflare_irradiance = determine_preflare_irradiance(self.light_curve.copy(),
                                                             estimated_time_of_peak_start=self.flare_peak_time)
+        assert np.isscalar(preflare_irradiance)
         assert_approx_equal(preflare_irradiance, 5.85e-5, significant=3)
 
     def low_median_diff_threshold_fails(self):
@@ -39,3 +42,16 @@ class TestBaselineDetermination:
         too_early_time = pd.Timestamp('2010-08-07 09:00:00')
         preflare_irradiance = determine_preflare_irradiance(self.light_curve.copy(), estimated_time_of_peak_start=too_early_time)
         assert preflare_irradiance is np.nan
+
+    def multiple_light_curves_match_single_light_curves(self):
+        preflare_irradiances = determine_preflare_irradiance(self.light_curves.copy(),
+                                                             estimated_time_of_peak_start=self.flare_peak_time)
+        assert isinstance(preflare_irradiances, np.ndarray)
+        assert len(preflare_irradiances) == len(self.light_curves.columns)
+
+        for i, column in enumerate(self.light_curves):
+            light_curve = pd.DataFrame(self.light_curves[column])
+            light_curve.columns = ['irradiance']
+            preflare_irradiance = determine_preflare_irradiance(light_curve, estimated_time_of_peak_start=self.flare_peak_time)
+            assert np.isscalar(preflare_irradiance)
+            assert_allclose(preflare_irradiances[i], preflare_irradiance, rtol=1e-6)
@@ -0,0 +1,138 @@
+import jedi_config
+import generate_jedi_catalog
+import os
+from light_curve_peak_match_subtract import light_curve_peak_match_subtract
+from make_light_curve import label_aligned_peak_match_subtract
+from collections import OrderedDict
+import numpy as np
+from numpy.testing import assert_allclose
+import pandas as pd
+
+jedi_config.init()  # Configures and loads everything - takes about 60 seconds
+jedi_config.init_jedi_row()
+
+flare_index = 1000
+
+
+def make_synthetic_lines_event():
+    peak_time = pd.Timestamp(jedi_config.goes_flare_events['peak_time'][flare_index].iso)
+    times = pd.date_range(peak_time - pd.Timedelta(hours=2), periods=360, freq='min')
+    minutes = np.arange(len(times), dtype=np.float64)
+
+    # Gaussian flares on a slow trend with some wiggle; line d peaks too late to be shifted into line up
+    lines = OrderedDict()
+    for line, minutes_from_peak, amplitude in [('a', 0, 10.0), ('b', 3, 4.0), ('c', -5, 2.0), ('d', 45, 6.0)]:
+        lines[line] = (amplitude * np.exp(-0.5 * ((minutes - 120 - minutes_from_peak) / 8.0)**2) +
+                       0.01 * minutes + 0.1 * np.sin(minutes) + 1.0)
+    eve_lines_event = pd.DataFrame(lines, index=times)
+    eve_lines_event.iloc[10, 2] = np.nan  # Line c now has a different number of valid points than the others
+    eve_lines_event.iloc[[50, 200, 250], [0, 1, 3]] = np.nan  # The others have the same number, but with gaps in different places
+    eve_lines_event.iloc[60, 0] = np.nan
+    eve_lines_event.iloc[70, 1] = np.nan
+    eve_lines_event.iloc[80, 3] = np.nan
+    return eve_lines_event
+
+
+def test_flare_without_preflare_irradiance_gives_nan_row():
+    assert generate_jedi_catalog.map_flare_index_to_preflare_index(0) == -1
+
+    jedi_row = OrderedDict(zip(jedi_config.jedi_columns, generate_jedi_catalog.process_flare(0)))
+    assert jedi_row['Event #'] == 0
+    assert jedi_row['GOES Flare Class'] == jedi_config.goes_flare_events['class'][0]
+    assert pd.isnull(jedi_row['Pre-Flare Start Time'])
+    assert all(pd.isnull(value) for column, value in jedi_row.items() if column in jedi_config.preflare_irradiance_columns)
+    assert np.isnan(np.array(list(jedi_row.values()), dtype=object)[jedi_config.is_numeric_jedi_column].astype(np.float64)).all()
+
+
+def test_batched_peak_match_subtract_matches_label_aligned_subtraction(monkeypatch):
+    eve_lines_event = make_synthetic_lines_event()
+    line_names = eve_lines_event.columns.values.astype(str)
+    from_indices, with_indices = np.nonzero(~np.eye(len(line_names), dtype=bool))
+    ion_permutations = pd.Index(np.char.add(np.char.add(line_names[from_indices], ' by '), line_names[with_indices]), dtype=object)
+    monkeypatch.setattr(jedi_config, 'ion_from_indices', from_indices)
+    monkeypatch.setattr(jedi_config, 'ion_with_indices', with_indices)
+    monkeypatch.setattr(jedi_config, 'ion_permutations', ion_permutations)
+    monkeypatch.setattr(generate_jedi_catalog, 'jedi_row', OrderedDict())
+
+    batched = generate_jedi_catalog.loop_light_curve_peak_match_subtract(eve_lines_event.copy(), flare_index)
+    assert list(batched.columns) == list(line_names) + list(ion_permutations)
+
+    estimated_time_of_peak = pd.Timestamp(jedi_config.goes_flare_events['peak_time'][flare_index].iso)
+    n_corrected = 0
+    for i, ion_permutation in enumerate(ion_permutations):
+        corrected, seconds_shift, scale_factor = light_curve_peak_match_subtract(eve_lines_event[line_names[from_indices[i]]].values,
+                                                                                 eve_lines_event[line_names[with_indices[i]]].values,
+                                                                                 eve_lines_event.index,
+                                                                                 estimated_time_of_peak)
+        expected, expected_scale_factor = label_aligned_peak_match_subtract(eve_lines_event[line_names[from_indices[i]]],
+                                                                            eve_lines_event[line_names[with_indices[i]]],
+                                                                            estimated_time_of_peak)
+        assert_allclose(generate_jedi_catalog.jedi_row[ion_permutation + ' Correction Time Shift [s]'], seconds_shift)
+        assert_allclose(generate_jedi_catalog.jedi_row[ion_permutation + ' Correction Scale Factor'], scale_factor)
+        assert_allclose(generate_jedi_catalog.jedi_row[ion_permutation + ' Correction Scale Factor'], expected_scale_factor)
+
+        if expected is not None:
+            assert_allclose(batched[ion_permutation].values, expected.reindex(eve_lines_event.index).values)
+            assert_allclose(batched.loc[corrected.index, ion_permutation].values, corrected['irradiance'].values)
+            n_corrected += 1
+        else:
+            assert not isinstance(corrected, pd.DataFrame)
+            assert batched[ion_permutation].isna().all()
+
+    assert 0 < n_corrected < len(ion_permutations)  # Make sure both the subtracted and skipped paths were exercised
+
+
+def test_jedi_rows_round_trip_through_disk(tmpdir, monkeypatch):
+    monkeypatch.setattr(jedi_config, 'jedi_hdf_filename', os.path.join(str(tmpdir), 'jedi_test.h5'))
+    jedi_config.write_new_jedi_file_to_disk(jedi_config.init_jedi_row())
+
+    processed_row = OrderedDict.fromkeys(jedi_config.jedi_columns, np.nan)
+    processed_row['Event #'] = 1
+    processed_row['GOES Flare Peak Time'] = '2010-08-07 18:24:00'
+    processed_row['GOES Flare Class'] = 'M1.0'
+    processed_row['Flare Interrupt'] = False
+    processed_row['Flare Position Angle [deg]'] = 'N/A'
+    processed_row['17.1 Depth First [%]'] = 1.66
+    processed_row['17.1 Depth First Time'] = pd.Timestamp('2010-08-07 19:36:11')
+    processed_row['17.1 Depth Max Time'] = pd.NaT
+    processed_row['17.1 Duration [s]'] = 9780
+    nan_row = OrderedDict.fromkeys(jedi_config.jedi_columns, np.nan)
+    nan_row['Event #'] = 0
+    jedi_config.append_jedi_rows_to_disk([list(processed_row.values()), list(nan_row.values())], 0)
+
+    generate_jedi_catalog.merge_jedi_catalog_files(file_path=str(tmpdir) + '/')
+    merged_filename = [file for file in os.listdir(str(tmpdir)) if file.startswith('jedi_merged_')][0]
+    jedi_catalog_df = pd.read_hdf(os.path.join(str(tmpdir), merged_filename), 'jedi')
+
+    assert list(jedi_catalog_df.columns) == jedi_config.jedi_columns
+    assert list(jedi_catalog_df['Event #']) == [0, 1]
+    assert jedi_catalog_df.iloc[0, 1:].isna().all()
+    processed = jedi_catalog_df.iloc[1]
+    assert processed['GOES Flare Class'] == 'M1.0'
+    assert processed['Flare Position Angle [deg]'] == 'N/A'
+    assert processed['17.1 Depth First [%]'] == 1.66
+    assert pd.Timestamp(processed['17.1 Depth First Time']) == pd.Timestamp('2010-08-07 19:36:11')
+    assert pd.isnull(processed['17.1 Depth Max Time'])
+    assert processed['17.1 Duration [s]'] == 9780
+    assert np.isnan(processed['17.1 Depth Max [%]'])
+
+
+def test_merge_keeps_newest_run_of_each_event(tmpdir, monkeypatch):
+    def write_run(filename, depth):
+        monkeypatch.setattr(jedi_config, 'jedi_hdf_filename', os.path.join(str(tmpdir), filename))
+        jedi_config.write_new_jedi_file_to_disk(jedi_config.init_jedi_row())
+        processed_row = OrderedDict.fromkeys(jedi_config.jedi_columns, np.nan)
+        processed_row['Event #'] = 1
+        processed_row['17.1 Depth First [%]'] = depth
+        jedi_config.append_jedi_rows_to_disk([list(processed_row.values())], 0)
+
+    write_run('jedi_2018-01-01 00:00:00.000.h5', 1.0)
+    generate_jedi_catalog.merge_jedi_catalog_files(file_path=str(tmpdir) + '/')
+    write_run('jedi_2018-02-01 00:00:00.000.h5', 2.0)
+    generate_jedi_catalog.merge_jedi_catalog_files(file_path=str(tmpdir) + '/')
+
+    merged_filename = sorted(file for file in os.listdir(str(tmpdir)) if file.startswith('jedi_merged_'))[-1]
+    jedi_catalog_df = pd.read_hdf(os.path.join(str(tmpdir), merged_filename), 'jedi')
+
+    assert list(jedi_catalog_df['Event #']) == [1]
+    assert jedi_catalog_df['17.1 Depth First [%]'].iloc[0] == 2.0
@@ -37,6 +37,22 @@ def test_load_eve_data():
     assert isinstance(jedi_config.eve_lines.index, pd.DatetimeIndex)
 
 
+def test_clip_eve_lines():
+    sample_time = jedi_config.eve_lines.index[1000]
+    next_sample_time = jedi_config.eve_lines.index[1001]
+    start_time = (sample_time - pd.Timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+    end_time_on_sample = sample_time.strftime('%Y-%m-%d %H:%M:%S')
+    end_time_between_samples = (sample_time + (next_sample_time - sample_time) / 2).strftime('%Y-%m-%d %H:%M:%S')
+
+    eve_lines_clipped = jedi_config.clip_eve_lines(start_time, end_time_on_sample)
+    assert eve_lines_clipped.equals(jedi_config.eve_lines[start_time:end_time_on_sample])
+    assert eve_lines_clipped.index[-1] == sample_time
+
+    eve_lines_clipped = jedi_config.clip_eve_lines(start_time, end_time_between_samples)
+    assert eve_lines_clipped.equals(jedi_config.eve_lines[start_time:end_time_between_samples])
+    assert eve_lines_clipped.index[-1] == sample_time
+
+
 def test_load_goes_flare_event_data():
     import scipy.io.idl as idl
     assert isinstance(jedi_config.goes_flare_events, idl.AttrDict)
@@ -74,6 +90,19 @@ def test_preflare_indices_array():
     assert len(jedi_config.preflare_indices) > 1
 
 
+def test_map_flares_to_preflare_indices():
+    preflare_index_of_flare = jedi_config.map_flares_to_preflare_indices(np.array([3, 5]), 8)
+    assert preflare_index_of_flare[0] == -1  # Flare 0 can never be independent since there's nothing before it to compare to
+    assert list(preflare_index_of_flare[1:3]) == [-1, -1]  # Before any independent flare
+    assert list(preflare_index_of_flare[3:5]) == [0, 0]  # Flare 4 isn't independent so maps back to flare 3
+    assert list(preflare_index_of_flare[5:]) == [1, 1, 1]  # Including the last flare
+
+    assert len(jedi_config.preflare_index_of_flare) == len(jedi_config.goes_flare_events['class'])
+    assert jedi_config.preflare_index_of_flare[0] == -1
+    assert (jedi_config.preflare_index_of_flare[jedi_config.preflare_indices] == np.arange(len(jedi_config.preflare_indices))).all()
+    assert jedi_config.preflare_index_of_flare[-1] == len(jedi_config.preflare_indices) - 1
+
+
 def test_jedi_row():
     jedi_row = jedi_config.init_jedi_row()
     jedi_config.write_new_jedi_file_to_disk(jedi_row)
@@ -1,14 +1,18 @@
-from make_light_curve import make_light_curve, make_light_curve_284nm, normalized_irradiance_in_percent_units
+from make_light_curve import make_light_curve, make_light_curve_284nm, normalized_irradiance_in_percent_units, \
+    make_synthetic_light_curves, label_aligned_peak_match_subtract
 from light_curve_peak_match_subtract import light_curve_peak_match_subtract
-from numpy.testing import assert_approx_equal
+import numpy as np
+from numpy.testing import assert_approx_equal, assert_allclose
 import pandas as pd
 
 
 class TestPeakMatchSubtract:
 
     def test_peak_match_subtract(self):
-        self.subtract_from = normalized_irradiance_in_percent_units(make_light_curve())
-        self.subtract_with = normalized_irradiance_in_percent_units(make_light_curve_284nm())
+        light_curve_from = normalized_irradiance_in_percent_units(make_light_curve())
+        self.subtract_from = light_curve_from['irradiance'].values
+        self.subtract_with = normalized_irradiance_in_percent_units(make_light_curve_284nm())['irradiance'].values
+        self.times = light_curve_from.index
         self.flare_peak_time = pd.Timestamp('2010-08-07 18:24:00')
 
         self.nominal_case_returns_expected_values()
@@ -17,6 +21,7 @@ class TestPeakMatchSubtract:
     def nominal_case_returns_expected_values(self):
         corrected, seconds_shift, scale_factor = light_curve_peak_match_subtract(self.subtract_from,
                                                                                  self.subtract_with,
+                                                                                 self.times,
                                                                                  self.flare_peak_time)
         assert isinstance(corrected, pd.DataFrame)
         assert len(corrected) == 300
@@ -27,8 +32,25 @@ class TestPeakMatchSubtract:
         time_other_peak = pd.Timestamp('2010-08-07 20:00:00')
         corrected, seconds_shift, scale_factor = light_curve_peak_match_subtract(self.subtract_from,
                                                                                  self.subtract_with,
+                                                                                 self.times,
                                                                                  estimated_time_of_peak=time_other_peak)
         assert isinstance(corrected, pd.DataFrame)
         assert len(corrected) == 300
         assert seconds_shift == 360.0
         assert_approx_equal(scale_factor, 0.0687, significant=3)
+
+    def test_mismatched_nan_gaps_subtract_by_time(self):
+        flare_peak_time = pd.Timestamp('2010-08-07 18:24:00')
+        light_curve_from, light_curve_with = make_synthetic_light_curves(flare_peak_time, nan_rows_from=[50, 200], nan_rows_with=[80, 250])
+
+        corrected, seconds_shift, scale_factor = light_curve_peak_match_subtract(light_curve_from.values,
+                                                                                 light_curve_with.values,
+                                                                                 light_curve_from.index,
+                                                                                 flare_peak_time)
+        expected, expected_scale_factor = label_aligned_peak_match_subtract(light_curve_from, light_curve_with, flare_peak_time)
+
+        assert isinstance(corrected, pd.DataFrame)
+        assert corrected.index.equals(expected.index)
+        assert_allclose(corrected['irradiance'].values, expected.values)
+        assert_approx_equal(scale_factor, expected_scale_factor)
+        assert np.isnan(corrected['irradiance'].loc[light_curve_from.index[[50, 80, 200, 250]]]).all()